@@ -0,0 +1,83 @@
+"""Micro-benchmark of the request envelopes of the member pushes
+
+Compares a member push through ``ccommander.remotes.soap_call`` with and
+without CCOMMANDER_FAST_SERIALIZER: building a synchroMember with the suds
+factory and letting suds marshal the insertOrUpdateMemberByObj envelope,
+against the Records and precompiled templates of ``ccommander.envelopes``.
+
+The client doesn't send anything (nosend), but the whole call path is
+measured: the injected envelope is still parsed and written again by suds.
+The render of the templates alone is reported too.
+
+Usage: python benchmarks/bench_envelopes.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': ':memory:'}},
+        INSTALLED_APPS=['ccommander'],
+        CCOMMANDER_API_MEMBER_UPDATE_WSDL='http://localhost/member?wsdl',
+        CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL='http://localhost/ccmd?wsdl',
+        CCOMMANDER_API_NOTIFICATION_WSDL='http://localhost/nms?wsdl',
+    )
+
+import suds.client
+
+from ccommander.envelopes import get_serializer
+from ccommander.remotes import soap_call, soap_object
+
+WSDL = os.path.join(os.path.dirname(__file__), os.pardir, 'ccommander',
+                    'fixtures', 'wsdl', 'member.wsdl')
+
+ENTRIES = [{'key': 'FIELD%d' % i, 'value': u'value %d' % i}
+           for i in range(20)]
+
+
+def fill(member):
+    member.email = 'member@mail.com'
+    member.memberUID = 'email:member@mail.com'
+    member.dynContent.entry.extend(ENTRIES)
+    return member
+
+
+def push(client):
+    soap_call(client, 'insertOrUpdateMemberByObj', 'token',
+              fill(soap_object(client, 'synchroMember')))
+
+
+def timed(func, iterations):
+    return min(timeit.repeat(func, number=iterations, repeat=3)) / iterations
+
+
+def main(iterations=2000):
+    client = suds.client.Client('file://' + os.path.abspath(WSDL),
+                                cache=None, nosend=True)
+    serializer = get_serializer(client)
+
+    def render():
+        serializer.render('insertOrUpdateMemberByObj', 'token',
+                          fill(serializer.create('synchroMember')))
+
+    settings.CCOMMANDER_FAST_SERIALIZER = False
+    suds_time = timed(lambda: push(client), iterations)
+    settings.CCOMMANDER_FAST_SERIALIZER = True
+    push(client)
+    fast_time = timed(lambda: push(client), iterations)
+    render_time = timed(render, iterations)
+
+    print "soap_call, suds:        %8.1f us/call" % (suds_time * 1e6)
+    print "soap_call, templates:   %8.1f us/call" % (fast_time * 1e6)
+    print "  of which the render:  %8.1f us/call" % (render_time * 1e6)
+    print "speedup:                %8.1fx" % (suds_time / fast_time)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,63 @@
+"""Benchmark of the cost of importing the ccommander models
+
+Every Django process loading the app imports ccommander.models. Each run
+imports it in a fresh interpreter and reports the median wall time, along
+with the time of importing the SOAP stack on top of it (what the models
+used to pay up front) and whether suds or pika got loaded.
+
+Usage: python benchmarks/bench_import.py [runs]
+"""
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+SCRIPT = """
+import json, sys, time
+from django.conf import settings
+settings.configure(
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                           'NAME': ':memory:'}},
+    INSTALLED_APPS=['ccommander'],
+    CCOMMANDER_API_MEMBER_UPDATE_WSDL='http://localhost/member?wsdl',
+    CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL='http://localhost/ccmd?wsdl',
+    CCOMMANDER_API_NOTIFICATION_WSDL='http://localhost/nms?wsdl',
+)
+import django.db.models
+started = time.time()
+import ccommander.models
+imported = time.time()
+soap = [name for name in ('suds', 'pika') if name in sys.modules]
+if %(with_soap)r:
+    import suds.client
+json.dump({'models': imported - started, 'total': time.time() - started,
+           'soap_loaded': soap}, sys.stdout)
+"""
+
+
+def measure(with_soap):
+    output = subprocess.check_output(
+        [sys.executable, '-c', SCRIPT % {'with_soap': with_soap}], cwd=ROOT)
+    return json.loads(output)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(runs=9):
+    lazy = [measure(False) for _ in range(runs)]
+    eager = [measure(True) for _ in range(runs)]
+    print json.dumps({
+        'runs': runs,
+        'models_import': median([r['models'] for r in lazy]),
+        'models_import_with_suds': median([r['total'] for r in eager]),
+        'soap_loaded_by_models': lazy[0]['soap_loaded'],
+    }, indent=2)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,92 @@
+"""Micro-benchmark of the model -> SOAP object mapping used by the remotes
+
+Compares the per-save ``_meta`` introspection the remotes used to do with the
+precompiled plans of ``ccommander.mappers``. Both timings include creating
+the stand-in of the suds object, which costs the same for both.
+
+Usage: python benchmarks/bench_mapping.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': ':memory:'}},
+        INSTALLED_APPS=['ccommander'],
+        CCOMMANDER_API_MEMBER_UPDATE_WSDL='http://localhost/member?wsdl',
+        CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL='http://localhost/ccmd?wsdl',
+        CCOMMANDER_API_NOTIFICATION_WSDL='http://localhost/nms?wsdl',
+    )
+
+from ccommander.mappers import DELETE, serialize
+from ccommander.models import Campaign, Message, Segment
+
+
+class RemoteObject(object):
+    """Stands for the suds object created by client.factory.create"""
+
+    def __init__(self):
+        for field in Campaign._meta.fields:
+            setattr(self, getattr(field, 'remote_name', field.name), None)
+
+
+def legacy_serialize(instance, m):
+    """The loop every Remote.save used to run"""
+    for field in instance._meta.fields:
+        if field.primary_key:
+            continue
+
+        field_name = field.name
+        if hasattr(field, 'remote_name'):
+            remote_field_name = field.remote_name
+        else:
+            remote_field_name = field_name
+
+        value = getattr(instance, field_name)
+        if value is None:
+            if hasattr(field, 'remote_default_value'):
+                value = field.remote_default_value
+                if callable(value):
+                    value = value(m, instance)
+            else:
+                value = ''
+        elif hasattr(field, 'remote_value'):
+            value = field.remote_value
+            if callable(value):
+                value = value(m, instance)
+
+        if value == DELETE:
+            delattr(m, remote_field_name)
+        else:
+            setattr(m, remote_field_name, value)
+    return m
+
+
+def main(iterations=20000):
+    campaign = Campaign(name='Campaign', url_end_campaign='http://url',
+                        message=Message(pk=1, remote_id=10),
+                        segment=Segment(pk=1, remote_id=20))
+
+    assert (vars(legacy_serialize(campaign, RemoteObject())) ==
+            vars(serialize(campaign, RemoteObject())))
+
+    legacy = min(timeit.repeat(
+        lambda: legacy_serialize(campaign, RemoteObject()),
+        number=iterations, repeat=3))
+    compiled = min(timeit.repeat(
+        lambda: serialize(campaign, RemoteObject()),
+        number=iterations, repeat=3))
+
+    print 'legacy:   %.2f us/object' % (legacy / iterations * 1e6)
+    print 'compiled: %.2f us/object' % (compiled / iterations * 1e6)
+    print 'speedup:  %.2fx' % (legacy / compiled)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,233 @@
+"""Local fake of the Campaign Commander SOAP services
+
+Serves stripped down WSDLs of the member, campaign management and
+notification services with the operations the remotes use, and answers
+every call with a canned response after a configurable latency. It's only
+meant to measure our side of the calls, nothing is validated nor stored.
+
+>>> server = FakeCampaignCommander(latency=0.05)
+>>> server.start()
+>>> server.wsdl('member')
+'http://127.0.0.1:53012/member?wsdl'
+
+It can also be run standalone:
+
+    python benchmarks/fakecc.py [port] [latency in ms]
+"""
+import itertools
+import random
+import re
+import sys
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+NAMESPACE = 'http://api.ccmd.emailvision.com'
+
+ENTRY_LIST = [('entry', 'tns:entry', True)]
+
+TYPES = {
+    'entry': ['key', 'value'],
+    'entryList': ENTRY_LIST,
+    'synchroMember': ['email', 'memberUID', ('dynContent', 'tns:entryList')],
+    'apiMessage': ['id', 'name', 'subject', 'description', 'encoding', 'from',
+                   'fromEmail', 'replyTo', 'replyToEmail', 'to', 'type',
+                   'hotmailUnsubUrl', 'isBounceback', 'body', 'createDate'],
+    'apiSegmentation': ['id', 'name', 'description', 'sampleRate',
+                        'sampleType', 'dateCreate', 'dateModif'],
+    'apiStringDemographicCriteria': ['id', 'groupName', 'orderFrag',
+                                     'groupNumber', 'columnName', 'operator',
+                                     ('values', 'xs:string', True)],
+    'apiNumericDemographicCriteria': ['id', 'groupName', 'orderFrag',
+                                      'groupNumber', 'columnName', 'operator',
+                                      'firstValue', 'secondValue'],
+    'apiCampaign': ['id', 'name', 'description', 'analytics', 'deliverySpeed',
+                    'emaildedupflg', 'lifeStatus', 'notification',
+                    'postClickTracking', 'sendDate', 'status', 'strategy',
+                    'target', 'urlEndCampaign', 'valid', 'format', 'urlHost',
+                    'segmentIds', 'mailinglistId', 'messageId'],
+    'sendRequest': ['email', 'notificationId', 'random', 'encrypt',
+                    'synchrotype', 'uidkey', 'senddate',
+                    ('dyn', 'tns:entryList'), ('content', 'tns:entryList')],
+    'multiSendRequest': [('sendrequest', 'tns:sendRequest', True)],
+}
+
+SESSION_OPERATIONS = {
+    'openApiConnection': ['login', 'pwd', 'key'],
+    'closeApiConnection': ['token'],
+}
+
+SERVICES = {
+    'member': dict(SESSION_OPERATIONS, **{
+        'insertOrUpdateMemberByObj': ['token', ('member', 'tns:synchroMember')],
+        'rejoinMemberByEmail': ['token', 'email'],
+        'unjoinMemberByEmail': ['token', 'email'],
+    }),
+    'ccmd': dict(SESSION_OPERATIONS, **{
+        'createEmailMessageByObj': ['token', ('message', 'tns:apiMessage')],
+        'createAndAddStandardUrl': ['token', 'messageId', 'name', 'url'],
+        'createAndAddUnsubscribeUrl': ['token', 'messageId', 'name', 'pageOK',
+                                       'messageOK', 'pageKO', 'messageKO'],
+        'createAndAddMirrorUrl': ['token', 'messageId', 'name'],
+        'segmentationCreateSegment': ['token',
+                                      ('segment', 'tns:apiSegmentation')],
+        'segmentationAddStringDemographicCriteriaByObj': [
+            'token', ('criteria', 'tns:apiStringDemographicCriteria')],
+        'segmentationAddNumericDemographicCriteriaByObj': [
+            'token', ('criteria', 'tns:apiNumericDemographicCriteria')],
+        'createCampaignByObj': ['token', ('campaign', 'tns:apiCampaign')],
+        'postCampaign': ['token', 'id'],
+    }),
+    'nms': {
+        'sendObject': [('arg0', 'tns:sendRequest')],
+        'sendObjects': [('arg0', 'tns:multiSendRequest')],
+    },
+}
+
+RETURN_TYPES = {
+    'postCampaign': 'xs:boolean',
+}
+
+
+def _element(field):
+    if isinstance(field, basestring):
+        field = (field, 'xs:string')
+    name, type = field[:2]
+    many = len(field) > 2 and field[2]
+    return ('<xs:element name="%s" type="%s" minOccurs="0"%s/>' %
+            (name, type, ' maxOccurs="unbounded"' if many else ''))
+
+
+def _sequence(fields):
+    return ('<xs:complexType><xs:sequence>%s</xs:sequence></xs:complexType>' %
+            ''.join(_element(field) for field in fields))
+
+
+def render_wsdl(service, location):
+    """Returns the WSDL document of the service, bound to location"""
+    operations = SERVICES[service]
+    types = ''.join('<xs:complexType name="%s"><xs:sequence>%s</xs:sequence>'
+                    '</xs:complexType>' % (name, ''.join(map(_element, fields)))
+                    for name, fields in sorted(TYPES.items()))
+    elements, messages, port, binding = [], [], [], []
+    for op, params in sorted(operations.items()):
+        returns = [('return', RETURN_TYPES.get(op, 'xs:string'))]
+        elements.append('<xs:element name="%s">%s</xs:element>'
+                        '<xs:element name="%sResponse">%s</xs:element>' %
+                        (op, _sequence(params), op, _sequence(returns)))
+        messages.append('<wsdl:message name="%s"><wsdl:part name="parameters" '
+                        'element="tns:%s"/></wsdl:message>'
+                        '<wsdl:message name="%sResponse"><wsdl:part '
+                        'name="parameters" element="tns:%sResponse"/>'
+                        '</wsdl:message>' % (op, op, op, op))
+        port.append('<wsdl:operation name="%s"><wsdl:input message="tns:%s"/>'
+                    '<wsdl:output message="tns:%sResponse"/></wsdl:operation>'
+                    % (op, op, op))
+        binding.append('<wsdl:operation name="%s"><soap:operation '
+                       'soapAction=""/><wsdl:input><soap:body use="literal"/>'
+                       '</wsdl:input><wsdl:output><soap:body use="literal"/>'
+                       '</wsdl:output></wsdl:operation>' % op)
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<wsdl:definitions xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" '
+        'xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/" '
+        'xmlns:xs="http://www.w3.org/2001/XMLSchema" '
+        'xmlns:tns="%(ns)s" targetNamespace="%(ns)s">'
+        '<wsdl:types><xs:schema targetNamespace="%(ns)s" '
+        'elementFormDefault="unqualified">%(types)s%(elements)s</xs:schema>'
+        '</wsdl:types>%(messages)s'
+        '<wsdl:portType name="%(name)sPort">%(port)s</wsdl:portType>'
+        '<wsdl:binding name="%(name)sBinding" type="tns:%(name)sPort">'
+        '<soap:binding style="document" '
+        'transport="http://schemas.xmlsoap.org/soap/http"/>%(binding)s'
+        '</wsdl:binding><wsdl:service name="%(name)sService">'
+        '<wsdl:port name="%(name)sPort" binding="tns:%(name)sBinding">'
+        '<soap:address location="%(location)s"/></wsdl:port></wsdl:service>'
+        '</wsdl:definitions>' % {
+            'ns': NAMESPACE, 'name': service, 'location': location,
+            'types': types, 'elements': ''.join(elements),
+            'messages': ''.join(messages), 'port': ''.join(port),
+            'binding': ''.join(binding)})
+
+
+RESPONSE = ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<soap:Envelope '
+            'xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">'
+            '<soap:Body><ns:%sResponse xmlns:ns="%s"><return>%s</return>'
+            '</ns:%sResponse></soap:Body></soap:Envelope>')
+
+OPERATION = re.compile(r'<(?:[\w-]+:)?Body[^>]*>\s*<(?:[\w-]+:)?(\w+)')
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body, content_type='text/xml; charset=utf-8'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.path.strip('/').split('?')[0]
+        if service not in SERVICES:
+            return self.send_error(404)
+        location = 'http://%s:%d/%s' % (self.server.server_address +
+                                        (service,))
+        self.send(render_wsdl(service, location))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length')))
+        op = OPERATION.search(body).group(1)
+        self.server.calls[op] = self.server.calls.get(op, 0) + 1
+        self.server.wait()
+        if op == 'openApiConnection':
+            value = 'token-%d' % next(self.server.ids)
+        elif op == 'postCampaign':
+            value = 'true'
+        else:
+            value = str(next(self.server.ids))
+        self.send(RESPONSE % (op, NAMESPACE, value, op))
+
+
+class FakeCampaignCommander(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server faking the SOAP services
+
+    Every call waits latency seconds (plus up to jitter seconds) before
+    answering, calls counts the calls received per operation.
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0):
+        HTTPServer.__init__(self, (host, port), Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = {}
+        self.ids = itertools.count(1)
+
+    def wait(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def wsdl(self, service):
+        return 'http://%s:%d/%s?wsdl' % (self.server_address + (service,))
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8089
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.0
+    server = FakeCampaignCommander(port=port, latency=latency)
+    for service in sorted(SERVICES):
+        print server.wsdl(service)
+    server.serve_forever()
@@ -0,0 +1,252 @@
+"""Throughput benchmarks of the Campaign Commander integration
+
+Runs the remotes, the api and the rpc server against a local fake of the
+SOAP services (see fakecc.py) and prints the results as JSON, so they can be
+stored and compared between revisions.
+
+Usage: python benchmarks/run.py [options] [scenario ...]
+
+Without DJANGO_SETTINGS_MODULE a minimal configuration is used, in which case
+the scenarios depending on ccommander.api (that needs the project's
+addbuyer_admin app) are reported as skipped.
+"""
+import collections
+import datetime
+import json
+import optparse
+import os
+import platform
+import Queue
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from fakecc import FakeCampaignCommander
+
+
+def configure(server):
+    """Points the WSDL settings to the fake server
+
+    It must run before ccommander.remotes is imported
+    """
+    from django.conf import settings
+
+    wsdls = {
+        'CCOMMANDER_API_MEMBER_UPDATE_WSDL': server.wsdl('member'),
+        'CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL': server.wsdl('ccmd'),
+        'CCOMMANDER_API_NOTIFICATION_WSDL': server.wsdl('nms'),
+    }
+    if os.environ.get('DJANGO_SETTINGS_MODULE'):
+        for name, value in wsdls.items():
+            setattr(settings, name, value)
+    else:
+        settings.configure(
+            DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                                   'NAME': ':memory:'}},
+            INSTALLED_APPS=['ccommander'],
+            CCOMMANDER_API_USER='bench',
+            CCOMMANDER_API_PASSWORD='bench',
+            CCOMMANDER_API_KEY='bench',
+            **wsdls)
+
+
+class Skipped(Exception):
+    pass
+
+
+def member_save(options):
+    """One insertOrUpdateMemberByObj per Member save"""
+    from ccommander.models import Member
+
+    remote = Member._remote
+    for i in xrange(options.members):
+        remote.save(Member(email='member%d@mail.com' % i))
+    return options.members
+
+
+def member_bulk_sync(options):
+    """MemberRemote.save_many over the same members"""
+    from ccommander.models import Member
+
+    members = (Member(email='member%d@mail.com' % i)
+               for i in xrange(options.members))
+    failures = Member._remote.save_many(members)
+    assert not failures, failures
+    return options.members
+
+
+def campaign_build(options):
+    """Message + links + segment + criteria + campaign + post"""
+    from ccommander.models import (Message, Link, MirrorLink, UnsubscribeLink,
+                                   Segment, Criteria, NumericCriteria,
+                                   Campaign)
+
+    for i in xrange(1, options.campaigns + 1):
+        message = Message(pk=i, name='Message', subject='Subject',
+                          to='[EMV FIELD]EMAIL[EMV /FIELD]', body='Body')
+        message.remote_id = message._remote.save(message)
+        for link in (Link(name='Link', url='http://url', message=message),
+                     MirrorLink(name='Mirror', message=message),
+                     UnsubscribeLink(name='Unsubscribe', url='http://ok',
+                                     error_url='http://ko', message=message)):
+            link._remote.save(link)
+
+        segment = Segment(pk=i, name='Segment')
+        segment.remote_id = segment._remote.save(segment)
+        for criteria in (Criteria(column_name='EMAIL', operator='EQUALS',
+                                  values=['email1@mail.com', 'email2@mail.com'],
+                                  segment=segment),
+                         NumericCriteria(column_name='IS_ACTIVE',
+                                         operator='EQUALS', first_value=1,
+                                         segment=segment)):
+            criteria._remote.save(criteria)
+
+        campaign = Campaign(pk=i, name='Campaign',
+                            url_end_campaign='http://url',
+                            message=message, segment=segment)
+        campaign.remote_id = campaign._remote.save(campaign)
+        campaign._remote.post(campaign)
+    return options.campaigns
+
+
+def _transactional_requests(options):
+    for i in xrange(options.requests):
+        yield {'email': 'member%d@mail.com' % i, 'id': 1, 'random': 'R',
+               'encrypt': 'E', 'dyn': {'FIRSTNAME': 'Name'}}
+
+
+def transactional_batch(options):
+    """api.send_transactional_emails"""
+    try:
+        from ccommander import api
+    except ImportError, e:
+        raise Skipped(str(e))
+    failures = api.send_transactional_emails(_transactional_requests(options))
+    assert not failures, failures
+    return options.requests
+
+
+class FakeChannel(object):
+
+    def __init__(self):
+        self.acked = 0
+
+    def basic_ack(self, delivery_tag):
+        self.acked += 1
+
+    def basic_publish(self, **kwargs):
+        pass
+
+
+Method = collections.namedtuple('Method', 'delivery_tag routing_key')
+
+
+def rpc_drain(options):
+    """rpc-server draining send_transactional_email requests
+
+    The broker is replaced by a fake channel, so only the dispatching,
+    the SOAP calls and the acking are measured.
+    """
+    from django.core.management import load_command_class
+    from ccommander import rpc
+    try:
+        command = load_command_class('ccommander', 'rpc-server')
+    except ImportError, e:
+        raise Skipped(str(e))
+
+    channel = FakeChannel()
+    command.verbosity = 0
+    command.coalesce_window = 0
+    command.coalesced = collections.OrderedDict()
+    command.finished = Queue.Queue()
+    command.pool = ThreadPool(options.workers) if options.workers > 1 else None
+    command.channel = channel
+    command.dead_letter_queue = 'dead'
+    command.lanes = collections.OrderedDict([(rpc.DEFAULT, rpc.Lane(
+        rpc.DEFAULT, 'rpc', concurrency=options.workers))])
+    command.lane_of_queue = {'rpc': rpc.DEFAULT}
+    command.scheduler = rpc.Scheduler(command.lanes)
+
+    for tag, request in enumerate(_transactional_requests(options)):
+        body = json.dumps({'method': 'send_transactional_email',
+                           'kwargs': request})
+        command.on_request_deferred(channel, Method(tag, 'rpc'), None, body)
+    while channel.acked < options.requests:
+        command.send_acks()
+        command.run_scheduled()
+        time.sleep(0.001)
+    if command.pool is not None:
+        command.pool.close()
+    return options.requests
+
+
+SCENARIOS = collections.OrderedDict([
+    ('member_save', member_save),
+    ('member_bulk_sync', member_bulk_sync),
+    ('campaign_build', campaign_build),
+    ('transactional_batch', transactional_batch),
+    ('rpc_drain', rpc_drain),
+])
+
+
+def run(server, name, options):
+    calls = dict(server.calls)
+    started = time.time()
+    try:
+        operations = SCENARIOS[name](options)
+    except Skipped, e:
+        return {'scenario': name, 'skipped': str(e)}
+    seconds = time.time() - started
+    return {
+        'scenario': name,
+        'operations': operations,
+        'seconds': round(seconds, 4),
+        'operations_per_second': round(operations / seconds, 2),
+        'remote_calls': dict((op, count - calls.get(op, 0))
+                             for op, count in server.calls.items()
+                             if count != calls.get(op, 0)),
+    }
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [scenario ...]',
+                                   description=', '.join(SCENARIOS))
+    parser.add_option('--latency', type='float', default=20,
+                      help='Milliseconds the fake server waits per call')
+    parser.add_option('--jitter', type='float', default=0,
+                      help='Random milliseconds added to the latency')
+    parser.add_option('--members', type='int', default=200)
+    parser.add_option('--campaigns', type='int', default=10)
+    parser.add_option('--requests', type='int', default=200)
+    parser.add_option('--workers', type='int', default=8,
+                      help='rpc-server workers in rpc_drain')
+    parser.add_option('--output', help='Write the results to this file')
+    options, names = parser.parse_args()
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error('Unknown scenario %s' % name)
+
+    server = FakeCampaignCommander(latency=options.latency / 1000,
+                                   jitter=options.jitter / 1000)
+    server.start()
+    configure(server)
+
+    report = {
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'latency_ms': options.latency,
+        'jitter_ms': options.jitter,
+        'results': [run(server, name, options) for name in names or SCENARIOS],
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    print output
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
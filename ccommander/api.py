@@ -2,13 +2,21 @@
 Move ccommander/management to addbuyer_admin/management since this is not
 app agnostic
 """
+import copy
 import datetime
 import time
+from multiprocessing.pool import ThreadPool
 
-import suds
 from django.conf import settings
+from django.template.loader import render_to_string
 from django.utils.log import getLogger, NullHandler
 
+from ccommander.asyncremotes import submit
+from ccommander.cache import LRUCache
+from ccommander.models import Member
+from ccommander.pool import get_pool
+from ccommander.remotes import chunked, soap_call, soap_object
+
 from addbuyer_admin.models import User, Demand, Wish
 # from addbuyer_admin.shortcuts import send_campaign_to_offerers
 
@@ -18,43 +26,182 @@ if not logger.handlers:
     logger.addHandler(NullHandler())
 
 
-def send_transactional_email(email, id, random, encrypt, dyn=None, content=None):
-    """Sends an email using the Campaign Commander Transactional API
+def _notification_client():
+    """Returns a client for the notification WSDL, parsed once per process"""
+    return get_pool(settings.CCOMMANDER_API_NOTIFICATION_WSDL).get_client()
 
-    email is the email address
-    template is the template to use
+
+# sendRequests filled with everything but the recipient, by notification
+_prototypes = LRUCache(getattr(settings, 'CCOMMANDER_PROTOTYPE_CACHE_SIZE', 100))
+
+# rendered content blocks, by template and parameters
+_content_blocks = LRUCache(getattr(settings, 'CCOMMANDER_CONTENT_CACHE_SIZE',
+                                   1000))
+
+
+def _freeze(mapping):
+    return tuple(sorted(mapping.items())) if mapping else ()
+
+
+def render_content_block(template_name, params=None):
+    """Renders a content block template for the content of a transactional
+    email, identical blocks are only rendered once
+
+    params must be hashable values
     """
-    client = suds.client.Client(settings.CCOMMANDER_API_NOTIFICATION_WSDL)
-    request = client.factory.create('sendRequest')
+    key = (template_name, _freeze(params))
+    block = _content_blocks.get(key)
+    if block is None:
+        block = render_to_string(template_name, params or {})
+        _content_blocks.set(key, block)
+    return block
+
+
+def _request_prototype(client, id, random, encrypt, content=None):
+    """Returns a sendRequest with the values shared by every recipient of
+    the notification, built once per notification and content
+    """
+    key = (id, random, encrypt, _freeze(content))
+    try:
+        prototype = _prototypes.get(key)
+    except TypeError:
+        # unhashable content values, it can't be cached
+        key = prototype = None
+    if prototype is not None:
+        return prototype
+
+    prototype = soap_object(client, 'sendRequest')
+    prototype.synchrotype = 'NOTHING'
+    prototype.uidkey = 'email'
+    prototype.notificationId = id
+    prototype.random = random
+    prototype.encrypt = encrypt
+    if content:
+        prototype.content.entry.extend([{'key': k, 'value': v}
+                                        for k, v in content.items()])
+    else:
+        del prototype.content
+    if key is not None:
+        _prototypes.set(key, prototype)
+    return prototype
+
+
+def _build_request(client, email, id, random, encrypt, dyn=None,
+                   content=None):
+    request = copy.deepcopy(_request_prototype(client, id, random, encrypt,
+                                               content))
     request.email = email
-    request.notificationId = id
-    request.random = random
-    request.encrypt = encrypt
-    request.synchrotype = 'NOTHING'
-    request.uidkey = 'email'
     request.senddate = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-
     if dyn:
-        for key, value in dyn.items():
-            request.dyn.entry.append({'key': key, 'value': value})
+        request.dyn.entry.extend([{'key': k, 'value': v}
+                                  for k, v in dyn.items()])
     else:
         del request.dyn
+    return request
 
-    if content:
-        for key, value in content.items():
-            request.content.entry.append({'key': key, 'value': value})
+
+def send_transactional_email(email, id, random, encrypt, dyn=None, content=None):
+    """Sends an email using the Campaign Commander Transactional API
+
+    email is the email address
+    template is the template to use
+    """
+    client = _notification_client()
+    soap_call(client, 'sendObject', _build_request(client, email, id, random,
+                                                   encrypt, dyn, content))
+
+
+def send_transactional_email_async(email, id, random, encrypt, dyn=None,
+                                   content=None):
+    """Sends an email in the background, see send_transactional_email
+
+    Returns an AsyncResult, see ccommander.asyncremotes
+    """
+    return submit(send_transactional_email, email, id, random, encrypt, dyn,
+                  content)
+
+
+def send_transactional_emails(requests, chunk_size=None):
+    """Sends many emails using the Campaign Commander Transactional API
+
+    requests is an iterable of dicts with the arguments of
+    send_transactional_email. They are sent in chunks through the multi-send
+    operation of the notification service when it has one, otherwise the
+    single sends of every chunk are pipelined over a few threads
+    (CCOMMANDER_NOTIFICATION_CONCURRENCY).
+
+    Returns a list of (request, exception) tuples with the failed requests
+    """
+    chunk_size = chunk_size or getattr(settings,
+                                       'CCOMMANDER_NOTIFICATION_CHUNK_SIZE', 100)
+    client = _notification_client()
+    if 'sendObjects' in client.wsdl.services[0].ports[0].methods:
+        send_chunk = _send_multi
     else:
-        del request.content
+        send_chunk = _send_pipelined
+
+    failures = []
+    for chunk in chunked(requests, chunk_size):
+        failures.extend(send_chunk(client, chunk))
+    return failures
 
-    client.service.sendObject(request)
+
+def _send_multi(client, chunk):
+    try:
+        multi = soap_object(client, 'multiSendRequest')
+        multi.sendrequest = [_build_request(client, **r) for r in chunk]
+        soap_call(client, 'sendObjects', multi)
+    except Exception, e:
+        return [(r, e) for r in chunk]
+    return []
+
+
+def _send_pipelined(client, chunk):
+    def send(r):
+        try:
+            soap_call(_notification_client(), 'sendObject',
+                      _build_request(client, **r))
+        except Exception, e:
+            return r, e
+
+    workers = ThreadPool(min(len(chunk), getattr(
+        settings, 'CCOMMANDER_NOTIFICATION_CONCURRENCY', 8)))
+    try:
+        return [failure for failure in workers.map(send, chunk) if failure]
+    finally:
+        workers.close()
+
+
+def reconcile_remote(models=None, dry_run=False, full=False):
+    """Reconciles the local rows with the objects modified in Campaign
+    Commander, see ccommander.reconcile
+
+    models is a list of model names (all the reconciled models by default)
+    """
+    from django.db.models import get_model
+    from ccommander import reconcile
+
+    if models is None:
+        models = reconcile.MODELS
+    else:
+        models = [get_model('ccommander', name) for name in models]
+    for report in reconcile.reconcile(models, dry_run, full):
+        logger.info(unicode(report))
 
 
 def sync_user(email):
-    """Syncs an user with Campaign Commander"""
+    """Syncs an user with Campaign Commander
+
+    The member is pushed even when nothing changed since it was loaded, this
+    is how a member whose earlier push failed gets repaired
+    """
     # time.sleep(10)
     user = User.objects.filter(email=email).get()
     # trigger callbacks
     user.save()
+    # they skip the push when the member didn't change
+    for member in Member.objects.filter(email=email):
+        member.save(force_remote=True)
 
 
 def send_campaign_to_demand(demand_id):
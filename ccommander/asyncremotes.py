@@ -0,0 +1,111 @@
+"""Non-blocking variants of the remotes
+
+Every method of an async remote returns right away with an AsyncResult while
+the call runs on a process-wide pool of CCOMMANDER_ASYNC_WORKERS threads,
+sharing the session pools of the blocking remotes:
+
+>>> remote = AsyncMemberRemote()
+>>> results = [remote.save(member) for member in members]
+>>> gather(results, return_exceptions=True)
+
+Calls are serialized exactly as the blocking remotes do (see
+ccommander.mappers). The number of calls in flight is bounded by the size of
+the session pools, the others wait in the queue of the worker pool.
+"""
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from ccommander import remotes
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns the process-wide thread pool running the async calls"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPool(
+                    getattr(settings, 'CCOMMANDER_ASYNC_WORKERS', 16))
+    return _executor
+
+
+def submit(func, *args, **kwargs):
+    """Runs func in the executor, returns its AsyncResult"""
+    return get_executor().apply_async(func, args, kwargs)
+
+
+def gather(results, timeout=None, return_exceptions=False):
+    """Waits for the given AsyncResults and returns their values in order
+
+    The first failure is raised unless return_exceptions is True, in which
+    case exceptions are returned in place of the values.
+    """
+    values = []
+    for result in results:
+        try:
+            values.append(result.get(timeout))
+        except Exception, e:
+            if not return_exceptions:
+                raise
+            values.append(e)
+    return values
+
+
+class AsyncRemote(object):
+    """Proxy of a remote whose method calls are submitted to the executor"""
+
+    remote_class = None
+
+    def __init__(self, remote=None):
+        self.remote = remote or self.remote_class()
+
+    def __getattr__(self, name):
+        method = getattr(self.remote, name)
+        if not callable(method) or name.startswith('_'):
+            return method
+
+        def call(*args, **kwargs):
+            return submit(method, *args, **kwargs)
+        return call
+
+
+class AsyncMemberRemote(AsyncRemote):
+    remote_class = remotes.MemberRemote
+
+
+class AsyncMessageRemote(AsyncRemote):
+    remote_class = remotes.MessageRemote
+
+
+class AsyncSegmentRemote(AsyncRemote):
+    remote_class = remotes.SegmentRemote
+
+
+class AsyncCriteriaRemote(AsyncRemote):
+    remote_class = remotes.CriteriaRemote
+
+
+class AsyncNumericCriteriaRemote(AsyncRemote):
+    remote_class = remotes.NumericCriteriaRemote
+
+
+class AsyncCampaignRemote(AsyncRemote):
+    remote_class = remotes.CampaignRemote
+
+
+class AsyncLinkRemote(AsyncRemote):
+    remote_class = remotes.LinkRemote
+
+
+class AsyncUnsubscribeLinkRemote(AsyncRemote):
+    remote_class = remotes.UnsubscribeLinkRemote
+
+
+class AsyncMirrorLinkRemote(AsyncRemote):
+    remote_class = remotes.MirrorLinkRemote
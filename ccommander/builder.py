@@ -0,0 +1,138 @@
+"""One-shot creation of a whole campaign
+
+Saving a Message, its links, a Segment, its criteria and the Campaign one by
+one opens an API session and a transaction per object. CampaignBuilder
+pushes the whole graph over a single API session, running the independent
+branches (the message and its links, the segment and its criteria) in
+parallel, and then saves every local row in one transaction.
+
+>>> builder = CampaignBuilder(
+...     message=Message(name="Message", subject="Subject", body="Body",
+...                     to="[EMV FIELD]EMAIL[EMV /FIELD]"),
+...     links=[MirrorLink(name="Mirror")],
+...     segment=Segment(name="Segment"),
+...     criteria=[Criteria(column_name="EMAIL", operator="EQUALS",
+...                        values=["email1@mail.com", "email2@mail.com"])],
+...     campaign=Campaign(name="Campaign", url_end_campaign="http://url"))
+>>> campaign = builder.build(post=True)
+"""
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import models, transaction
+
+from ccommander.pool import get_pool
+from ccommander.remotes import bind_connection
+
+
+class CampaignBuilder(object):
+    """Creates a message, its links, a segment, its criteria and the campaign
+    using both, in Campaign Commander and locally
+
+    Nothing is saved locally if a remote call fails, but the objects already
+    created remotely are left there (the API can't delete them).
+    """
+
+    def __init__(self, message, segment, campaign, links=(), criteria=()):
+        self.message = message
+        self.segment = segment
+        self.campaign = campaign
+        self.links = list(links)
+        self.criteria = list(criteria)
+
+        for link in self.links:
+            link.message = message
+        for criteria in self.criteria:
+            criteria.segment = segment
+        campaign.message = message
+        campaign.segment = segment
+
+    def build(self, post=False):
+        """Pushes the graph, saves it and posts the campaign if post is True
+
+        Returns the campaign
+        """
+        self.wsdl = settings.CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL
+        self.pool = get_pool(self.wsdl)
+        self.workers = ThreadPool(getattr(settings,
+                                          'CCOMMANDER_BUILDER_CONCURRENCY', 4))
+        self.aborted = False
+        try:
+            with self.pool.connection() as (client, con):
+                self.con = con
+                segment = self.workers.apply_async(self._call,
+                                                   (self._push_segment,))
+                try:
+                    with bind_connection(self.wsdl, client, con):
+                        self._push_message()
+                except:
+                    self.aborted = True
+                    raise
+                finally:
+                    # the segment branch must be done with the session before
+                    # it's given back or closed
+                    segment.wait()
+                segment.get()
+                with bind_connection(self.wsdl, client, con):
+                    self._push_campaign(post)
+        finally:
+            self.workers.close()
+        self._save()
+        return self.campaign
+
+    def _call(self, func, *args):
+        """Runs func with the builder's session bound in this thread"""
+        with bind_connection(self.wsdl, self.pool.get_client(), self.con):
+            return func(*args)
+
+    def _push(self, instance):
+        # auto_now fields are only set when saving, the remote wants them now
+        for field in instance._meta.fields:
+            if getattr(field, 'auto_now', False) or getattr(
+                    field, 'auto_now_add', False):
+                field.pre_save(instance, True)
+        result = instance._remote.save(instance)
+        if hasattr(instance, 'remote_id'):
+            instance.remote_id = result
+
+    def _push_message(self):
+        self._push(self.message)
+        # links only depend on the message, push them at once
+        results = [self.workers.apply_async(self._call, (self._push, link))
+                   for link in self.links]
+        for result in results:
+            result.wait()
+        for result in results:
+            result.get()
+
+    def _push_segment(self):
+        self._push(self.segment)
+        # criteria are added in order, the first one of a group creates it
+        for criteria in self.criteria:
+            if self.aborted:
+                return
+            self._push(criteria)
+
+    def _push_campaign(self, post):
+        self._push(self.campaign)
+        if post:
+            self.campaign._remote.post(self.campaign)
+
+    def _save(self):
+        """Saves every row in a transaction without calling the remotes"""
+        with transaction.commit_on_success(using='ccommander_app'):
+            models.Model.save(self.message)
+            models.Model.save(self.segment)
+            for link in self.links:
+                link.message = self.message
+                models.Model.save(link)
+            for criteria in self.criteria:
+                criteria.segment = self.segment
+                models.Model.save(criteria)
+            self.campaign.message = self.message
+            self.campaign.segment = self.segment
+            models.Model.save(self.campaign)
+
+        for instance in ([self.message, self.segment, self.campaign] +
+                         self.links + self.criteria):
+            instance._remote_pushed()
@@ -0,0 +1,126 @@
+"""Caches of the app
+
+LRUCache keeps items in process. The read cache of the remotes (see
+``get_read_cache``) is either one of them or the Django cache, as set by
+CCOMMANDER_READ_CACHE:
+
+    CCOMMANDER_READ_CACHE = 'memory'    # or 'django', or a dotted path
+    CCOMMANDER_READ_CACHE_TTL = 60      # seconds, 0 disables the cache
+    CCOMMANDER_READ_CACHE_SIZE = 1000   # items kept by the memory backend
+    CCOMMANDER_READ_CACHE_ALIAS = 'default'  # cache of the django backend
+
+Backends take the ttl at construction and have get, set, delete and clear
+methods.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+
+class LRUCache(object):
+    """Thread safe mapping keeping the max_size most recently used items,
+    for ttl seconds if given
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._items.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                return default
+            self._items[key] = (value, expires)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, expires)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        item = self._items.get(key)
+        return item is not None and (item[1] is None or item[1] > time.time())
+
+
+class DjangoCache(object):
+    """Read cache backend storing items in a cache of Django, shared by the
+    processes using it. Values must be picklable.
+    """
+
+    def __init__(self, ttl=None, alias=None, prefix='ccommander:'):
+        from django.core.cache import get_cache
+        self.ttl = ttl
+        self.prefix = prefix
+        self._cache = get_cache(alias or getattr(
+            settings, 'CCOMMANDER_READ_CACHE_ALIAS', 'default'))
+
+    def get(self, key, default=None):
+        return self._cache.get(self.prefix + key, default)
+
+    def set(self, key, value, ttl=None):
+        self._cache.set(self.prefix + key, value, ttl or self.ttl)
+
+    def delete(self, key):
+        self._cache.delete(self.prefix + key)
+
+    def clear(self):
+        # the Django cache may be shared with the project, it's left alone
+        pass
+
+
+def _memory_cache(ttl):
+    return LRUCache(getattr(settings, 'CCOMMANDER_READ_CACHE_SIZE', 1000), ttl)
+
+
+BACKENDS = {
+    'memory': _memory_cache,
+    'django': DjangoCache,
+}
+
+_read_cache = None
+_lock = threading.Lock()
+
+
+def get_read_cache():
+    """Returns the process-wide read cache of the remotes, None when
+    CCOMMANDER_READ_CACHE_TTL is 0
+    """
+    global _read_cache
+    if _read_cache is None:
+        with _lock:
+            if _read_cache is None:
+                ttl = getattr(settings, 'CCOMMANDER_READ_CACHE_TTL', 60)
+                name = getattr(settings, 'CCOMMANDER_READ_CACHE', 'memory')
+                if not ttl:
+                    _read_cache = False
+                elif name in BACKENDS:
+                    _read_cache = BACKENDS[name](ttl)
+                else:
+                    module, attr = name.rsplit('.', 1)
+                    _read_cache = getattr(import_module(module), attr)(ttl)
+    return _read_cache if _read_cache is not False else None
@@ -0,0 +1,217 @@
+"""Fast path serializing the SOAP requests of the remotes
+
+suds builds the objects returned by ``client.factory.create`` and the
+request envelopes by walking the schema on every call. For the operations
+the remotes send in bulk the schema is instead walked once, into a template
+listing the elements of each type, and envelopes are written straight into
+a string from it:
+
+>>> serializer = get_serializer(client)
+>>> member = serializer.create('synchroMember')
+>>> member.email = 'member@mail.com'
+>>> envelope = serializer.render('insertOrUpdateMemberByObj', token, member)
+>>> client.service.insertOrUpdateMemberByObj(__inject={'msg': envelope})
+
+``create`` returns light Records shaped like the suds objects (nested objects
+for complex elements, lists for repeated ones and None for the rest), and
+``render`` accepts suds objects too. The envelopes are the ones suds would
+send: optional elements with a None value, an empty list or an object
+without any significant value are left out, values are converted by the
+schema types of suds, and only document/literal operations are supported.
+
+Remotes use it when CCOMMANDER_FAST_SERIALIZER is enabled.
+"""
+import threading
+from xml.sax.saxutils import escape
+
+ENVELOPE_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+
+HEAD = ('<?xml version="1.0" encoding="UTF-8"?><SOAP-ENV:Envelope '
+        'xmlns:ns0="%s" xmlns:ns1="%%s" '
+        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        'xmlns:SOAP-ENV="%s"><SOAP-ENV:Header/><ns0:Body><ns1:%%s>'
+        % (ENVELOPE_NS, ENVELOPE_NS))
+
+TAIL = '</ns1:%s></ns0:Body></SOAP-ENV:Envelope>'
+
+
+class Record(object):
+    """Attribute holder standing for a suds object, deleting a missing
+    attribute is not an error
+    """
+
+    def __delattr__(self, name):
+        self.__dict__.pop(name, None)
+
+    def __repr__(self):
+        return 'Record(%s)' % ', '.join('%s=%r' % item
+                                        for item in sorted(vars(self).items()))
+
+
+class Node(object):
+    """An element of the schema: its name, whether it's optional, repeated
+    or namespace qualified, and either its builtin type or its children
+    """
+
+    def __init__(self, name, optional, many, qualified, builtin=None,
+                 children=None):
+        self.name = name
+        self.tag = ('ns1:' if qualified else '') + name
+        self.optional = optional
+        self.many = many
+        self.builtin = builtin
+        self.children = children
+
+    def new(self):
+        if self.many:
+            return []
+        if self.children is None:
+            return None
+        record = Record()
+        for child in self.children:
+            setattr(record, child.name, child.new())
+        return record
+
+    def write(self, out, value):
+        if value is None:
+            if not self.optional:
+                out.append('<%s/>' % self.tag)
+            return
+        if self.many and isinstance(value, (list, tuple)):
+            for item in value:
+                self.write_one(out, item)
+        else:
+            self.write_one(out, value)
+
+    def write_one(self, out, value):
+        if self.children is None:
+            value = self.builtin.translate(value, False)
+            if not isinstance(value, basestring):
+                value = unicode(value)
+            out.append('<%s>%s</%s>' % (self.tag, escape(value), self.tag))
+            return
+        if isinstance(value, dict):
+            get = value.get
+        else:
+            get = lambda name: getattr(value, name, None)
+        if self.optional and not self.footprint(get):
+            return
+        out.append('<%s>' % self.tag)
+        start = len(out)
+        for child in self.children:
+            child.write(out, get(child.name))
+        if len(out) == start:
+            out[-1] = '<%s/>' % self.tag
+        else:
+            out.append('</%s>' % self.tag)
+
+    def footprint(self, get):
+        """Returns the number of significant values of an object (given its
+        attribute getter), the way suds counts them to drop empty optional
+        objects
+        """
+        count = 0
+        for child in self.children:
+            item = get(child.name)
+            if item is None:
+                continue
+            if isinstance(item, (basestring, dict, list, tuple)):
+                count += bool(len(item))
+            elif child.children is not None:
+                count += child.footprint(
+                    lambda name: getattr(item, name, None))
+            else:
+                count += 1
+        return count
+
+
+class Serializer(object):
+    """Templates of the types and operations of the WSDL of a suds client,
+    compiled on first use
+    """
+
+    def __init__(self, client):
+        self.wsdl = client.wsdl
+        self._types = {}
+        self._operations = {}
+        self._lock = threading.Lock()
+
+    def _compile(self, element, ancestry=(), stack=()):
+        resolved = element.resolve()
+        optional = element.optional() or any(a.optional() for a in ancestry)
+        node = Node(element.name, optional, element.multi_occurrence(),
+                    element.form_qualified)
+        if resolved.builtin():
+            node.builtin = resolved
+        elif resolved in stack:
+            raise ValueError('Recursive type %s' % resolved.name)
+        else:
+            node.children = [self._compile(child, ancestry,
+                                           stack + (resolved,))
+                             for child, ancestry in resolved.children()]
+        return node
+
+    def _type(self, name):
+        node = self._types.get(name)
+        if node is None:
+            with self._lock:
+                for (type_name, ns), type in self.wsdl.schema.types.items():
+                    if type_name == name:
+                        node = Node(name, False, False, False, children=[
+                            self._compile(child, ancestry, (type,))
+                            for child, ancestry in type.children()])
+                        break
+                else:
+                    raise TypeError('Type %s not found' % name)
+                self._types[name] = node
+        return node
+
+    def _operation(self, name):
+        operation = self._operations.get(name)
+        if operation is None:
+            with self._lock:
+                method = self.wsdl.services[0].ports[0].methods[name]
+                body = method.soap.input.body
+                if (method.soap.style != 'document' or body.use != 'literal'
+                        or not body.wrapped):
+                    raise ValueError('Only wrapped document/literal '
+                                     'operations are supported, not %s' % name)
+                element, namespace = body.parts[0].element
+                params = [self._compile(param)
+                          for _, param, _ in method.binding.input.param_defs(
+                              method)]
+                operation = (HEAD % (escape(namespace), element), params,
+                             TAIL % element)
+                self._operations[name] = operation
+        return operation
+
+    def create(self, type_name):
+        """Returns a Record shaped like client.factory.create(type_name)"""
+        return self._type(type_name).new()
+
+    def render(self, operation, *args):
+        """Returns the request envelope of operation called with args,
+        encoded in UTF-8
+        """
+        head, params, tail = self._operation(operation)
+        out = [head]
+        for param, value in zip(params, args):
+            param.write(out, value)
+        out.append(tail)
+        return u''.join(out).encode('utf-8')
+
+
+_serializers = {}
+_serializers_lock = threading.Lock()
+
+
+def get_serializer(client):
+    """Returns the process-wide serializer of the WSDL of client"""
+    key = client.wsdl.url
+    serializer = _serializers.get(key)
+    if serializer is None:
+        with _serializers_lock:
+            serializer = _serializers.get(key)
+            if serializer is None:
+                serializer = _serializers[key] = Serializer(client)
+    return serializer
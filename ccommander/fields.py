@@ -1,36 +1,144 @@
+import collections
+
 from django.db import models
 from django import forms
 
+
+class LazyStringList(collections.MutableSequence):
+    """List of strings only split from the raw column value when it's first
+    accessed, so loading rows with large value lists is cheap
+
+    It's not a list subclass, since C code reading lists directly (list
+    concatenation, str.join, json) would see it empty. Use list(values) when
+    a real list is needed, mappers.serialize does it for the remote.
+    """
+
+    __hash__ = None
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._values = None
+
+    @property
+    def decoded(self):
+        return self._values is not None
+
+    def decode(self):
+        """Returns the list of values, splitting the raw value if needed"""
+        if self._values is None:
+            self._values = StringListField.split(self.raw)
+        return self._values
+
+    def __getitem__(self, index):
+        return self.decode()[index]
+
+    def __setitem__(self, index, value):
+        self.decode()[index] = value
+
+    def __delitem__(self, index):
+        del self.decode()[index]
+
+    def __len__(self):
+        return len(self.decode())
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def __contains__(self, value):
+        return value in self.decode()
+
+    def insert(self, index, value):
+        self.decode().insert(index, value)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, LazyStringList)):
+            return self.decode() == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __add__(self, other):
+        return self.decode() + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self.decode()
+
+    def __repr__(self):
+        return repr(self.decode())
+
+
 class StringListField(models.Field):
     """
     Save a list of strings in a CharField (or TextField) column.
 
     In the django model object the column is a list of strings.
     http://www.djangosnippets.org/snippets/1491/
+
+    With storage='delimited' the values are also wrapped by the separator
+    and the column starts with a marker (\\x1e\\vvalue1\\vvalue2\\v), which
+    allows querying single values:
+
+    >>> Criteria.objects.filter(values__contains='email1@mail.com')
+
+    Both formats are read whatever the storage, rows are written in the
+    field's format when they are saved. An empty list is stored as '' in
+    both, so the joined format can't tell [''] from []. Values are split lazily, see LazyStringList.
     """
     __metaclass__=models.SubfieldBase
 
     SPLIT_CHAR=u'\v'
+    # first character of the delimited format, never found in joined values
+    DELIMITED_MARK=u'\x1e'
+
+    JOINED = 'joined'
+    DELIMITED = 'delimited'
 
     def __init__(self, *args, **kwargs):
         self.internal_type=kwargs.pop('internal_type', 'CharField') # or TextField
+        self.storage=kwargs.pop('storage', self.JOINED)
         super(StringListField, self).__init__(*args, **kwargs)
 
+    @classmethod
+    def split(cls, value):
+        if not value:
+            return []
+        if value.startswith(cls.DELIMITED_MARK):
+            # delimited storage, the marker and the wrapping separators out
+            return value[2:-1].split(cls.SPLIT_CHAR)
+        return value.split(cls.SPLIT_CHAR)
+
     def to_python(self, value):
-        if isinstance(value, list):
+        if isinstance(value, (list, LazyStringList)):
             return value
         if value is None:
             return []
-        return value.split(self.SPLIT_CHAR)
+        return LazyStringList(value)
 
     def get_internal_type(self):
         return self.internal_type
 
-    def get_db_prep_lookup(self, lookup_type, value):
+    def get_prep_lookup(self, lookup_type, value):
         # SQL WHERE
+        if self.storage == self.DELIMITED:
+            if lookup_type == 'contains':
+                return self.SPLIT_CHAR + value + self.SPLIT_CHAR
+            if lookup_type == 'exact':
+                return self.get_prep_value(value)
+            if lookup_type == 'isnull':
+                return value
         raise NotImplementedError()
 
     def get_prep_value(self, value):
+        if isinstance(value, LazyStringList) and not value.decoded:
+            delimited = value.raw.startswith(self.DELIMITED_MARK)
+            if not value.raw or delimited == (self.storage == self.DELIMITED):
+                return value.raw
+        value = list(value)
+        if self.storage == self.DELIMITED and value:
+            return (self.DELIMITED_MARK + self.SPLIT_CHAR +
+                    self.SPLIT_CHAR.join(value) + self.SPLIT_CHAR)
         return self.SPLIT_CHAR.join(value)
 
     def formfield(self, **kwargs):
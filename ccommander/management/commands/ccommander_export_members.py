@@ -0,0 +1,68 @@
+import os
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ccommander.models import Member
+from ccommander.streaming import FORMATS, Checkpoint, RowWriter, guess_format
+
+
+class Command(BaseCommand):
+    """Exports the members to a CSV or JSON lines file
+
+    Members are streamed in primary key order from an iterator, the last
+    primary key written and the size of the file are stored in a checkpoint
+    file (the output path plus ".checkpoint" by default) every --chunk-size
+    rows. Running the command again truncates the file to that size and
+    appends the remaining members.
+    """
+    help = __doc__
+    args = '<path>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', choices=FORMATS,
+                    help='csv or jsonl (guessed from the extension)'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=1000),
+        make_option('--checkpoint', dest='checkpoint',
+                    help='Checkpoint file'),
+    )
+
+    def handle(self, path=None, **options):
+        if path is None:
+            raise CommandError('Missing the path of the file to export to')
+        verbosity = int(options['verbosity'])
+        format = options['format'] or guess_format(path)
+        fields = [f.name for f in Member._meta.fields if not f.primary_key]
+
+        checkpoint = Checkpoint(options['checkpoint'] or path + '.checkpoint')
+        state = checkpoint.load_state()
+        last_pk = state.get('position')
+        if last_pk is not None and verbosity:
+            print "[.] Resuming after member #%d" % last_pk
+
+        members = Member.objects.order_by('pk')
+        if last_pk is not None:
+            members = members.filter(pk__gt=last_pk)
+
+        started = time.time()
+        done = 0
+        with open(path, 'r+b' if last_pk is not None else 'wb') as f:
+            if last_pk is not None:
+                # drops the rows written after the checkpoint
+                f.truncate(state.get('offset', os.path.getsize(path)))
+                f.seek(0, os.SEEK_END)
+            writer = RowWriter(f, format, fields, header=last_pk is None)
+            for row in members.values('pk', *fields).iterator():
+                writer.write(row)
+                done += 1
+                if done % options['chunk_size'] == 0:
+                    f.flush()
+                    checkpoint.save(row['pk'], offset=f.tell())
+                    if verbosity:
+                        print "[.] %d members (%.0f members/s)" % (
+                            done, done / (time.time() - started))
+        checkpoint.clear()
+        if verbosity:
+            print "[x] Exported %d members" % done
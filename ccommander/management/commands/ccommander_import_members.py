@@ -0,0 +1,138 @@
+import itertools
+import sys
+import time
+from collections import OrderedDict
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+
+from ccommander.models import Member
+from ccommander.remotes import chunked
+from ccommander.streaming import FORMATS, Checkpoint, guess_format, read_rows
+
+
+class Command(BaseCommand):
+    """Imports members from a CSV or JSON lines file
+
+    Columns (or keys) are Member field names, email is required. Rows are
+    streamed in chunks: new members are inserted with bulk_create, existing
+    ones (by email) are updated when something changed, and the chunk is
+    then pushed to Campaign Commander over one connection.
+
+    The number of rows done is stored in a checkpoint file (the input path
+    plus ".checkpoint" by default) once every chunk has been pushed, running
+    the command again resumes from there. A chunk interrupted between its
+    local save and its push is pushed whole when resuming. The emails that
+    failed to be pushed are appended to the --failures file (the input path
+    plus ".failed" by default) so they can be pushed again.
+    """
+    help = __doc__
+    args = '<path>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', choices=FORMATS,
+                    help='csv or jsonl (guessed from the extension)'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=1000),
+        make_option('--checkpoint', dest='checkpoint',
+                    help='Checkpoint file'),
+        make_option('--no-remote', action='store_false', dest='remote',
+                    default=True, help="Don't push the members to the remote"),
+        make_option('--failures', dest='failures',
+                    help='File where the emails that failed are appended'),
+    )
+
+    def handle(self, path=None, **options):
+        if path is None:
+            raise CommandError('Missing the path of the file to import')
+        self.verbosity = int(options['verbosity'])
+        self.remote = options['remote']
+        self.fields = [f for f in Member._meta.fields if not f.primary_key]
+        self.counts = dict.fromkeys(('created', 'updated', 'unchanged',
+                                     'skipped', 'failed'), 0)
+
+        self.failures_path = options['failures'] or path + '.failed'
+
+        checkpoint = Checkpoint(options['checkpoint'] or path + '.checkpoint')
+        state = checkpoint.load_state()
+        done = state.get('position', 0)
+        # the chunk after the checkpoint may be saved but not pushed
+        self.push_all = state.get('pushing', False)
+        if done and self.verbosity:
+            print "[.] Resuming after %d rows" % done
+
+        started = time.time()
+        with open(path, 'rb') as f:
+            rows = read_rows(f, options['format'] or guess_format(path))
+            rows = itertools.islice(rows, done, None)
+            for chunk in chunked(rows, options['chunk_size']):
+                checkpoint.save(done, pushing=self.remote)
+                self.import_chunk(chunk)
+                self.push_all = False
+                done += len(chunk)
+                checkpoint.save(done)
+                if self.verbosity:
+                    print "[.] %d rows (%.0f rows/s): %s" % (
+                        done, done / (time.time() - started),
+                        ', '.join('%d %s' % (count, name) for name, count
+                                  in sorted(self.counts.items())))
+        checkpoint.clear()
+
+    def member_values(self, row):
+        row = dict((key.lower(), value) for key, value in row.items())
+        values = {}
+        for field in self.fields:
+            if field.name not in row:
+                continue
+            value = row[field.name]
+            if value in ('', None):
+                value = None if field.null else field.get_default()
+            else:
+                value = field.to_python(value)
+            values[field.name] = value
+        return values
+
+    def import_chunk(self, rows):
+        members = OrderedDict()
+        for row in rows:
+            values = self.member_values(row)
+            if not values.get('email'):
+                self.counts['skipped'] += 1
+                continue
+            members[values['email']] = values
+
+        created, updated, unchanged = [], [], []
+        with transaction.commit_on_success(using=router.db_for_write(Member)):
+            existing = dict((member.email, member) for member in
+                            Member.objects.filter(email__in=members.keys()))
+            for email, values in members.items():
+                member = existing.get(email)
+                if member is None:
+                    created.append(Member(**values))
+                    continue
+                for name, value in values.items():
+                    setattr(member, name, value)
+                if member.remote_changes():
+                    Member.objects.filter(pk=member.pk).update(**values)
+                    updated.append(member)
+                else:
+                    self.counts['unchanged'] += 1
+                    unchanged.append(member)
+            Member.objects.bulk_create(created)
+        self.counts['created'] += len(created)
+        self.counts['updated'] += len(updated)
+
+        if self.remote:
+            pushed = created + updated
+            if self.push_all:
+                pushed += unchanged
+            failures = Member._remote.save_many(pushed)
+            self.counts['failed'] += len(failures)
+            if failures:
+                with open(self.failures_path, 'a') as f:
+                    for member, e in failures:
+                        sys.stderr.write('[!] %s: %s\n' % (member.email, e))
+                        f.write(member.email.encode('utf-8') + '\n')
+            for member in updated:
+                member._remote_pushed()
@@ -0,0 +1,57 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from ccommander import reconcile
+
+
+class Command(BaseCommand):
+    """Pulls the messages, segments and campaigns modified in Campaign
+    Commander since the last run and applies them to the local rows
+
+    With --dry-run the changes are only reported. By default it runs once,
+    with --interval it keeps reconciling every that many seconds.
+    """
+    help = __doc__
+    args = '[model ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False, help="Report the changes, don't apply them"),
+        make_option('--full', action='store_true', dest='full', default=False,
+                    help='Ignore the watermarks and pull every remote object'),
+        make_option('--interval', type='float', dest='interval', default=None,
+                    help='Seconds between runs (runs once by default)'),
+    )
+
+    def handle(self, *names, **options):
+        verbosity = int(options['verbosity'])
+        models = reconcile.MODELS
+        if names:
+            models = [get_model('ccommander', name) for name in names]
+            if None in models or [m for m in models
+                                  if m not in reconcile.MODELS]:
+                raise CommandError('Models can be any of: %s' % ', '.join(
+                    m.__name__ for m in reconcile.MODELS))
+        try:
+            while True:
+                for report in reconcile.reconcile(models, options['dry_run'],
+                                                  options['full']):
+                    if verbosity:
+                        print "[.] %s" % report
+                    if verbosity > 1:
+                        for remote_id in report.created:
+                            print "    + %s" % remote_id
+                        for remote_id in report.updated:
+                            print "    ~ %s: %s" % (
+                                remote_id, ', '.join(report.changes[remote_id]))
+                        for remote_id, reason in report.skipped.items():
+                            print "    ! %s: %s" % (remote_id, reason)
+                if options['interval'] is None:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            if verbosity:
+                print "[x] Shutting down"
@@ -0,0 +1,54 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ccommander import metrics, outbox
+
+
+class Command(BaseCommand):
+    """Pushes the remote writes queued in the outbox to Campaign Commander
+
+    Only useful when CCOMMANDER_OUTBOX is enabled in django settings. By
+    default it runs forever polling the outbox every --interval seconds, use
+    --once to empty it and exit. Failed writes are tried again after an
+    exponential backoff, from CCOMMANDER_OUTBOX_RETRY_DELAY (1 second by
+    default) up to CCOMMANDER_OUTBOX_MAX_RETRY_DELAY (300). Writes rejected
+    CCOMMANDER_OUTBOX_MAX_ATTEMPTS times (10 by default) are parked: they
+    stay in the outbox for inspection but are no longer pushed. Writes that
+    failed because Campaign Commander was unreachable are never parked.
+
+    With --metrics-port the prometheus metrics of the dispatcher are served
+    over HTTP on that port.
+    """
+    help = __doc__
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Empty the outbox and exit'),
+        make_option('--interval', type='float', dest='interval', default=1.0,
+                    help='Seconds to wait when the outbox is empty'),
+        make_option('--limit', type='int', dest='limit', default=100,
+                    help='Writes pushed per round'),
+        make_option('--metrics-port', type='int', dest='metrics_port',
+                    default=None,
+                    help='Port where the prometheus metrics of this process '
+                         'are served (see ccommander.metrics)'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+        if options['metrics_port']:
+            metrics.serve(options['metrics_port'])
+        try:
+            while True:
+                pushed = outbox.dispatch(options['limit'])
+                if verbosity and pushed:
+                    print "[.] Pushed %d writes" % pushed
+                if not pushed:
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            if verbosity:
+                print "[x] Shutting down"
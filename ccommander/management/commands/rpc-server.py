@@ -1,15 +1,19 @@
 import json
-import pika
 import time
 import sys
 import traceback
+import Queue
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
 
 from django.utils.log import getLogger, NullHandler
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.core.mail import mail_admins
 
-from ccommander import api
+from ccommander import api, metrics, rpc
+from ccommander.resilience import CircuitOpenError
 
 logger = getLogger('ccommander.rpcserver')
 if not logger.handlers:
@@ -22,53 +26,269 @@ class Command(BaseCommand):
 
     It starts a rpc server listening from incomming request in the RabbitMQ
     queue specied as RABITMQ_RPC_QUEUE in django settings
+
+    With --workers greater than 1 requests are handed to a pool of threads so
+    that many SOAP calls can be in flight at once, acks are sent back from
+    the connection thread every ack_interval seconds. In every mode but the
+    plain one the broker delivers up to --prefetch unacknowledged messages
+    ahead, requests being merged by --coalesce-window count against it.
+
+    With --coalesce-window requests with the same method and arguments
+    received within that many seconds are merged: the method runs once and
+    every merged delivery is acked when it succeeds.
+
+    With RABITMQ_RPC_LANES and RABITMQ_RPC_ROUTES the api methods are
+    spread over several queues, each with its own concurrency limit, and
+    the free workers are shared between them by weight (see ccommander.rpc).
+    --workers and --prefetch then apply to the RABITMQ_RPC_QUEUE lane.
+
+    Failed requests are published to the dead letter queue
+    RABITMQ_RPC_DEAD_LETTER_QUEUE (the rpc queue name plus ".dead" by
+    default) and acked, so they are not redelivered in a loop. Requests that
+    found a circuit open (Campaign Commander is down) are not failed: they
+    are requeued and consuming pauses for RABITMQ_RPC_CIRCUIT_DELAY seconds
+    (5 by default).
+
+    With --metrics-port the prometheus metrics of the server are served
+    over HTTP on that port.
     """
     help = __doc__
 
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=1,
+                    help='Number of requests processed concurrently'),
+        make_option('--prefetch', type='int', dest='prefetch', default=None,
+                    help='Number of unacknowledged messages delivered ahead '
+                         '(defaults to twice the number of workers)'),
+        make_option('--coalesce-window', type='float', dest='coalesce_window',
+                    default=0,
+                    help='Seconds during which duplicated requests are merged '
+                         'into one (disabled by default)'),
+        make_option('--metrics-port', type='int', dest='metrics_port',
+                    default=None,
+                    help='Port where the prometheus metrics of this process '
+                         'are served (see ccommander.metrics)'),
+    )
+
+    # seconds between checks for finished and coalesced requests
+    ack_interval = 0.05
+
+    # no request is started before this time, see dispatch
+    paused_until = 0
+
     def handle(self, *args, **options):
-        self.verbosity = options['verbosity']
+        self.verbosity = int(options['verbosity'])
+        if options['metrics_port']:
+            metrics.serve(options['metrics_port'])
+        self.coalesce_window = options['coalesce_window']
+        self.coalesced = OrderedDict()
+        self.finished = Queue.Queue()
+        self.pool = None
+        self.lanes = rpc.get_lanes(options['workers'])
+        if options['prefetch']:
+            self.lanes[rpc.DEFAULT].prefetch = options['prefetch']
+        self.scheduler = rpc.Scheduler(self.lanes)
+        workers = sum(lane.concurrency for lane in self.lanes.values())
 
+        import pika
         connection = pika.BlockingConnection(pika.ConnectionParameters(
             **settings.RABITMQ_CONNECTION_PARAMS))
+        self.connection = connection
         channel = connection.channel()
         queue = settings.RABITMQ_RPC_QUEUE
         channel.queue_declare(queue=queue)
-        channel.basic_consume(self.on_request, queue=queue, no_ack=False)
+        self.dead_letter_queue = getattr(settings,
+                                         'RABITMQ_RPC_DEAD_LETTER_QUEUE',
+                                         queue + '.dead')
+        channel.queue_declare(queue=self.dead_letter_queue)
+        if len(self.lanes) > 1 or workers > 1 or self.coalesce_window:
+            if workers > 1:
+                self.pool = ThreadPool(workers)
+            for lane in self.lanes.values():
+                # a channel per lane so that each one gets its own prefetch
+                lane_channel = channel if lane.queue == queue else \
+                    connection.channel()
+                lane_channel.queue_declare(queue=lane.queue)
+                lane_channel.basic_qos(prefetch_count=lane.prefetch)
+                lane_channel.basic_consume(self.on_request_deferred,
+                                           queue=lane.queue, no_ack=False)
+            self.lane_of_queue = dict((lane.queue, lane.name)
+                                      for lane in self.lanes.values())
+            connection.add_timeout(self.ack_interval, self.on_timeout)
+        else:
+            channel.basic_consume(self.on_request, queue=queue, no_ack=False)
+        self.channel = channel
         try:
             if self.verbosity:
-                print "[x] Awaiting RPC requests"
+                print "[x] Awaiting RPC requests on %s" % ', '.join(
+                    lane.queue for lane in self.lanes.values())
             channel.start_consuming()
         except KeyboardInterrupt:
             if self.verbosity:
                 print "[x] Shutting down...",
         finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+            self.send_acks()
             connection.close()
             if self.verbosity:
                 print "connection closed",
 
-    def on_request(self, ch, method, props, body):
-        """
-        Expected body:
-        {
-            "method": ...,
-            "args": ...,
-            "kwargs": ...
-        }
+    def dispatch(self, body):
+        """Runs the api method requested in body
+
+        Returns True when the request succeeded and False when it failed,
+        failures are logged and mailed to the admins. Returns None when the
+        circuit of the remote is open, the request should be run again later
+        (the breaker already logged why it opened).
         """
-        data = json.loads(body)
+        data = body
         try:
+            data = json.loads(body)
             action = data['method']
             args = data.get('args', ())
             kwargs = data.get('kwargs', {})
             if self.verbosity:
                 print "[.] Received request to %s(%s, %s)" % (action, args, kwargs)
-            getattr(api, action)(*args, **kwargs)
+            with metrics.timer('rpc.dispatch.%s' % action):
+                getattr(api, action)(*args, **kwargs)
+        except CircuitOpenError, e:
+            logger.warning('Circuit %s is open, %r requeued', e, data)
+            metrics.incr('rpc.requeued')
+            return None
         except Exception, e:
             logger.error(e)
+            metrics.incr('rpc.failed')
             type, value, tb = sys.exc_info()
             message = 'RPC-SERVER has crashed:\n%s\n%s: %s\n\n%s\nargs:%r' % \
                     (e, type, value, '\n'.join(traceback.format_tb(tb)), data)
             mail_admins('RPC-SERVER ERROR', message)
+            return False
+        return True
+
+    def on_request(self, ch, method, props, body):
+        """
+        Expected body:
+        {
+            "method": ...,
+            "args": ...,
+            "kwargs": ...
+        }
+        """
+        ok = self.dispatch(body)
+        if ok is None:
+            # stop consuming while the remote is down
+            time.sleep(self.circuit_delay())
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            return
+        if not ok:
+            self.dead_letter(body)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def circuit_delay(self):
+        return getattr(settings, 'RABITMQ_RPC_CIRCUIT_DELAY', 5)
+
+    def on_request_deferred(self, ch, method, props, body):
+        """Coalesces the request or queues it in the backlog of its lane, see
+        on_request
+        """
+        tag = (ch, method.delivery_tag)
+        lane = self.lane_of_queue.get(method.routing_key, rpc.DEFAULT)
+        try:
+            data = json.loads(body)
+            lane = rpc.route(data['method']) or lane
+            key = (data['method'],
+                   json.dumps([data.get('args', ()), data.get('kwargs', {})],
+                              sort_keys=True))
+        except Exception:
+            # let dispatch report it
+            return self.submit(lane, body, [tag])
+        if not self.coalesce_window:
+            return self.submit(lane, body, [tag])
+        if key in self.coalesced:
+            self.coalesced[key][2].append(tag)
         else:
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            self.coalesced[key] = (lane, body, [tag], time.time())
+
+    def submit(self, lane, body, tags):
+        """Queues the request in the backlog of lane and runs what the
+        scheduler lets through
+        """
+        self.scheduler.add(lane, (body, tags, time.time()))
+        self.run_scheduled()
+
+    def run_scheduled(self):
+        """Runs the requests picked by the scheduler in the worker pool (or
+        right away without it), their delivery tags are queued to be acked
+        """
+        while time.time() >= self.paused_until:
+            picked = self.scheduler.next()
+            if picked is None:
+                return
+            lane, (body, tags, received_at) = picked
+            metrics.timing('rpc.wait.%s' % lane, time.time() - received_at)
+            if self.pool is None:
+                self.on_dispatched(lane, body, tags, self.dispatch(body))
+                # already in the connection thread, no need to wait the timer
+                self.send_acks()
+            else:
+                self.pool.apply_async(
+                    self.dispatch, (body,),
+                    callback=lambda ok, lane=lane, body=body, tags=tags:
+                        self.on_dispatched(lane, body, tags, ok))
+
+    def on_dispatched(self, lane, body, tags, ok):
+        """Frees the slot of the request in its lane and queues its delivery
+        tags to be acked, runs in the worker thread with a pool
+        """
+        self.scheduler.done(lane)
+        self.finished.put((body, tags, ok))
+
+    def flush_coalesced(self):
+        """Submits the coalesced requests whose window has expired"""
+        expired_at = time.time() - self.coalesce_window
+        while self.coalesced:
+            key, (lane, body, tags, received_at) = next(
+                self.coalesced.iteritems())
+            if received_at > expired_at:
+                break
+            del self.coalesced[key]
+            if len(tags) > 1:
+                metrics.incr('rpc.coalesced', len(tags) - 1)
+                if self.verbosity:
+                    print "[.] Merged %d requests to %s" % (len(tags), key[0])
+            self.submit(lane, body, tags)
+
+    def on_timeout(self):
+        self.flush_coalesced()
+        self.send_acks()
+        self.run_scheduled()
+        self.connection.add_timeout(self.ack_interval, self.on_timeout)
+
+    def send_acks(self):
+        """Acks the finished requests, must run in the connection thread
+
+        Failed requests are dead lettered before being acked, the ones that
+        found the circuit open are requeued and pause the scheduling
+        """
+        while True:
+            try:
+                body, tags, ok = self.finished.get_nowait()
+            except Queue.Empty:
+                return
+            if ok is None:
+                self.paused_until = time.time() + self.circuit_delay()
+                for channel, tag in tags:
+                    channel.basic_nack(delivery_tag=tag, requeue=True)
+                continue
+            if not ok:
+                self.dead_letter(body)
+            for channel, tag in tags:
+                channel.basic_ack(delivery_tag=tag)
 
+    def dead_letter(self, body):
+        metrics.incr('rpc.dead_lettered')
+        self.channel.basic_publish(exchange='',
+                                   routing_key=self.dead_letter_queue,
+                                   body=body)
@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ccommander import wsdl
+
+
+class Command(BaseCommand):
+    """Prewarms the on-disk cache of the WSDLs
+
+    Downloads and parses every CCOMMANDER_API_*_WSDL of django settings (or
+    the given urls) into CCOMMANDER_WSDL_CACHE_DIR, so workers can build
+    their clients without the network.
+    """
+    help = __doc__
+    args = '[url ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--clear', action='store_true', dest='clear',
+                    default=False, help='Only remove the cached copies'),
+    )
+
+    def handle(self, *urls, **options):
+        verbosity = int(options['verbosity'])
+        cache = wsdl.get_cache()
+        if cache is None:
+            raise CommandError('CCOMMANDER_WSDL_CACHE_DIR is not set')
+
+        for url in urls or wsdl.configured_wsdls():
+            if options['clear']:
+                cache.clear(url)
+            else:
+                cache.prewarm(url)
+            if verbosity:
+                print "[.] %s %s" % ('Cleared' if options['clear'] else 'Cached',
+                                     url)
@@ -0,0 +1,109 @@
+"""Mapping of model instances into the objects sent through SOAP
+
+Every field (but the primary key) of a model is sent to the remote object
+attribute named ``field.remote_name`` (the field name by default). The value
+sent can be tweaked with these field attributes:
+
+``remote_default_value``
+    used when the model's field value is None, it can be a value (primitive
+    python value), a callable which receives the remote object and the model
+    instance, or the special value DELETE to remove the attribute from the
+    remote object. Without it None is sent as ''.
+
+``remote_value``
+    used instead of the model's field value when it's not None, a value or a
+    callable like the above.
+
+Walking ``_meta.fields`` and checking for these attributes on every save is
+wasteful, so each model is compiled once into a plan, a flat tuple of steps
+(field name, remote name, default, remote value, conversion) that
+``serialize`` applies. Whatever can be decided per field, like whether a
+value is callable or must be converted, is decided while compiling.
+``deserialize`` goes the other way for the fields without a remote_value.
+"""
+
+from ccommander.fields import StringListField
+
+# Just an special attribute to detect when you want to remove attributes
+# from the object sent through SOAP, ex: the id attribute in an apiMessage
+# that is being created is meaningless, so you want to delete it if it's None
+# del apimessage.id
+DELETE = '_delete_'
+
+_NOTHING = object()
+
+_plans = {}
+
+
+def compile_plan(model):
+    """Returns the mapping plan of a model class"""
+    steps = []
+    for field in model._meta.fields:
+        if field.primary_key:
+            continue
+
+        remote_name = getattr(field, 'remote_name', field.name)
+        default = getattr(field, 'remote_default_value', '')
+        remote_value = getattr(field, 'remote_value', _NOTHING)
+        # SOAP marshallers only take real lists as arrays, not lazy ones
+        convert = list if isinstance(field, StringListField) else None
+        # read related objects rather than their raw id, an unsaved related
+        # instance has no id yet but it's still not None
+        steps.append((field.name, remote_name,
+                      default, callable(default),
+                      remote_value, callable(remote_value), convert))
+    return tuple(steps)
+
+
+def get_plan(model):
+    """Returns the (cached) mapping plan of a model class"""
+    plan = _plans.get(model)
+    if plan is None:
+        plan = _plans[model] = compile_plan(model)
+    return plan
+
+
+def serialize(instance, remote):
+    """Copies the values of the model instance into the remote object"""
+    for (name, remote_name, default, call_default,
+         remote_value, call_remote_value, convert) in get_plan(type(instance)):
+        value = getattr(instance, name)
+        if value is None:
+            value = default(remote, instance) if call_default else default
+        elif remote_value is not _NOTHING:
+            if call_remote_value:
+                value = remote_value(remote, instance)
+            else:
+                value = remote_value
+        elif convert is not None:
+            value = convert(value)
+        else:
+            # a field value, it can't be DELETE
+            setattr(remote, remote_name, value)
+            continue
+
+        if value == DELETE:
+            delattr(remote, remote_name)
+        else:
+            setattr(remote, remote_name, value)
+    return remote
+
+
+def deserialize(remote, model):
+    """Returns a dict with the model field values read from the remote
+    object
+
+    Fields with a remote_value (usually related objects) can't be mapped
+    back and are left out, as are the attributes missing (or None for
+    non nullable fields) in the remote object.
+    """
+    values = {}
+    for name, remote_name, _, _, remote_value, _, _ in get_plan(model):
+        if remote_value is not _NOTHING:
+            continue
+        value = getattr(remote, remote_name, None)
+        field = model._meta.get_field(name)
+        if value is None and not field.null:
+            continue
+        values[name] = field.to_python(value)
+    return values
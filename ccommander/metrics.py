@@ -0,0 +1,230 @@
+"""Timers and counters of the remote operations and the rpc server
+
+The exporters are set with CCOMMANDER_METRICS in django settings, a list of
+names (logging, statsd, prometheus) or dotted paths to exporter classes:
+
+    CCOMMANDER_METRICS = ['statsd', 'prometheus']
+    CCOMMANDER_STATSD_HOST = 'localhost'
+    CCOMMANDER_STATSD_PORT = 8125
+    CCOMMANDER_STATSD_PREFIX = 'ccommander'
+
+Without exporters (the default) ``timer``, ``timing`` and ``incr`` are bound
+to no-op functions, so the instrumentation costs a function call. Always
+call them through the module (``metrics.timer(...)``), they are rebound by
+``configure``.
+
+>>> with metrics.timer('remote.call.postCampaign'):
+...     client.service.postCampaign(con, campaign.remote_id)
+>>> metrics.incr('pool.hit')
+
+The prometheus exporter keeps the measures in the memory of each process.
+The web process exposes its own through ccommander.urls (the metrics
+view). The rpc-server and outbox-dispatcher processes, the ones making most
+of the SOAP calls, serve theirs over HTTP with --metrics-port (see serve).
+"""
+import re
+import socket
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from django.conf import settings
+from django.utils.importlib import import_module
+from django.utils.log import getLogger, NullHandler
+
+logger = getLogger('ccommander.metrics')
+if not logger.handlers:
+    logger.addHandler(NullHandler())
+
+
+class LoggingExporter(object):
+    """Logs every measure in the ccommander.metrics logger (debug level)"""
+
+    def timing(self, name, seconds):
+        logger.debug('%s %.2fms', name, seconds * 1000)
+
+    def incr(self, name, value):
+        logger.debug('%s +%d', name, value)
+
+
+class StatsdExporter(object):
+    """Sends the measures to a statsd server through UDP"""
+
+    def __init__(self):
+        self.address = (getattr(settings, 'CCOMMANDER_STATSD_HOST', 'localhost'),
+                        getattr(settings, 'CCOMMANDER_STATSD_PORT', 8125))
+        self.prefix = getattr(settings, 'CCOMMANDER_STATSD_PREFIX', 'ccommander')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, data):
+        try:
+            self.socket.sendto(data, self.address)
+        except socket.error:
+            pass
+
+    def timing(self, name, seconds):
+        self.send('%s.%s:%d|ms' % (self.prefix, name, seconds * 1000))
+
+    def incr(self, name, value):
+        self.send('%s.%s:%d|c' % (self.prefix, name, value))
+
+
+class PrometheusExporter(object):
+    """Aggregates the measures in memory to be scraped in the Prometheus text
+    format, see ccommander.views.metrics and serve
+    """
+    invalid_chars = re.compile(r'[^a-zA-Z0-9_]')
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+        self.lock = threading.Lock()
+
+    def timing(self, name, seconds):
+        with self.lock:
+            count, total = self.timers.get(name, (0, 0.0))
+            self.timers[name] = (count + 1, total + seconds)
+
+    def incr(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def metric_name(self, name):
+        return 'ccommander_' + self.invalid_chars.sub('_', name)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                name = self.metric_name(name)
+                lines.append('# TYPE %s_total counter' % name)
+                lines.append('%s_total %d' % (name, value))
+            for name, (count, total) in sorted(self.timers.items()):
+                name = self.metric_name(name)
+                lines.append('# TYPE %s_seconds summary' % name)
+                lines.append('%s_seconds_count %d' % (name, count))
+                lines.append('%s_seconds_sum %f' % (name, total))
+        return '\n'.join(lines) + '\n'
+
+
+EXPORTERS = {
+    'logging': LoggingExporter,
+    'statsd': StatsdExporter,
+    'prometheus': PrometheusExporter,
+}
+
+_exporters = []
+
+
+class _Timer(object):
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        _timing(self.name, time.time() - self.started)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+
+def _timing(name, seconds):
+    for exporter in _exporters:
+        exporter.timing(name, seconds)
+
+
+def _incr(name, value=1):
+    for exporter in _exporters:
+        exporter.incr(name, value)
+
+
+def _null_timer(name):
+    return _NULL_TIMER
+
+
+def _null(name, value=1):
+    pass
+
+
+timer = _null_timer
+timing = _null
+incr = _null
+
+
+def configure(exporters):
+    """Sets the exporters, names or dotted paths to their classes, and binds
+    timer, timing and incr accordingly
+    """
+    global timer, timing, incr
+    instances = []
+    for exporter in exporters:
+        if exporter in EXPORTERS:
+            cls = EXPORTERS[exporter]
+        else:
+            module, name = exporter.rsplit('.', 1)
+            cls = getattr(import_module(module), name)
+        instances.append(cls())
+    _exporters[:] = instances
+    if instances:
+        timer, timing, incr = _Timer, _timing, _incr
+    else:
+        timer, timing, incr = _null_timer, _null, _null
+
+
+def get_exporter(cls):
+    """Returns the configured exporter of the given class, if any"""
+    for exporter in _exporters:
+        if isinstance(exporter, cls):
+            return exporter
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        exporter = get_exporter(PrometheusExporter)
+        if self.path.split('?')[0] not in ('/', '/metrics') or exporter is None:
+            self.send_error(404)
+            return
+        body = exporter.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(port, address=''):
+    """Serves the measures of the prometheus exporter of this process over
+    HTTP (on /metrics) from a daemon thread, enabling the exporter if it's
+    not configured. Returns the server, shutdown() stops it.
+    """
+    global timer, timing, incr
+    if get_exporter(PrometheusExporter) is None:
+        _exporters.append(PrometheusExporter())
+        timer, timing, incr = _Timer, _timing, _incr
+    server = HTTPServer((address, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='ccommander-metrics')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+configure(getattr(settings, 'CCOMMANDER_METRICS', []))
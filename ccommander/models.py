@@ -1,24 +1,133 @@
 import datetime
 
+from django.conf import settings
 from django.db import transaction
 from django.db import models
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.utils import timezone
 
-from ccommander.fields import StringListField
+from ccommander import metrics
+from ccommander.fields import LazyStringList, StringListField
 from ccommander.remotes import (MemberRemote, MessageRemote, LinkRemote,
                                 MirrorLinkRemote, UnsubscribeLinkRemote,
                                 SegmentRemote, CriteriaRemote,
-                                NumericCriteriaRemote, CampaignRemote, DELETE)
+                                NumericCriteriaRemote, CampaignRemote, DELETE,
+                                chunked)
 
 def five_minutes_ahead():
     return datetime.datetime.now() + datetime.timedelta(minutes=5)
 
 
-class RemoteAtomic(object):
+class PendingSync(models.Model):
+    """Remote write waiting in the outbox
+
+    When CCOMMANDER_OUTBOX is enabled RemoteAtomic.save stores one of these
+    in the same transaction as the model row instead of calling the remote,
+    the outbox dispatcher (see ccommander.outbox) pushes them later.
+    """
+    model = models.CharField(_('Model'), max_length=100)
+    object_id = models.PositiveIntegerField(_('Object ID'))
+    created_at = models.DateTimeField(auto_now_add=True)
+    # failures that count towards parking, the remote rejected the write
+    attempts = models.PositiveIntegerField(_('Attempts'), default=0)
+    # consecutive failures of any kind, they set when it's tried again
+    retries = models.PositiveIntegerField(_('Retries'), default=0)
+    retry_at = models.DateTimeField(_('Retry at'), null=True, blank=True)
+    last_error = models.TextField(_('Last error'), blank=True)
+
+    class Meta:
+        verbose_name = _('Pending sync')
+        verbose_name_plural = _('Pending syncs')
+        ordering = ['pk']
+
+    def __unicode__(self):
+        return "%s #%s" % (self.model, self.object_id)
+
+    def get_model(self):
+        return models.get_model(*self.model.split('.'))
+
+
+class SyncWatermark(models.Model):
+    """Point up to which the remote objects of a model were reconciled
+
+    See ccommander.reconcile
+    """
+    model = models.CharField(_('Model'), max_length=100, unique=True)
+    synced_until = models.DateTimeField(_('Synced until'), null=True)
+    synced_at = models.DateTimeField(_('Synced at'), null=True)
+
+    class Meta:
+        verbose_name = _('Sync watermark')
+        verbose_name_plural = _('Sync watermarks')
+
+    def __unicode__(self):
+        return "%s: %s" % (self.model, self.synced_until)
+
+
+class RemoteTracking(object):
+    """Mixin keeping a snapshot of the values sent to the remote
+
+    The snapshot is taken when the instance is loaded and after every remote
+    push, so saves that don't change any of those values can skip the remote
+    call. RemoteTracking.skipped_remote_calls counts the skipped calls.
+    """
+    skipped_remote_calls = 0
+
+    def __init__(self, *args, **kwargs):
+        super(RemoteTracking, self).__init__(*args, **kwargs)
+        if self.pk is None:
+            self._remote_snapshot = None
+        else:
+            self._remote_snapshot = self._remote_values()
+
+    def _remote_values(self):
+        values = {}
+        for field in self._meta.fields:
+            if field.primary_key:
+                continue
+            value = getattr(self, field.attname)
+            if isinstance(value, (list, LazyStringList)):
+                # its column value: a copy, and lazy lists aren't decoded
+                value = field.get_prep_value(value)
+            values[field.attname] = value
+        return values
+
+    def remote_changes(self):
+        """Returns the names of the fields changed since the last push, or
+        None if the instance has never been pushed
+        """
+        if self._remote_snapshot is None:
+            return None
+        snapshot = self._remote_snapshot
+        return [name for name, value in self._remote_values().items()
+                if snapshot.get(name) != value]
+
+    def _remote_pushed(self):
+        self._remote_snapshot = self._remote_values()
+
+    def _skip_remote(self):
+        RemoteTracking.skipped_remote_calls += 1
+        metrics.incr('remote.skipped')
+
+
+class RemoteAtomic(RemoteTracking):
     """Mixin for transactional operations with both, models and remotes"""
 
     def save(self, *args, **kwargs):
+        """Saves the row and pushes it to the remote in one transaction
+
+        With push=False only the row is saved, the push is left to the
+        caller (see Segment.push_criteria).
+        """
+        if not kwargs.pop('push', True):
+            kwargs.pop('force_remote', None)
+            return super(RemoteAtomic, self).save(*args, **kwargs)
+        # changes must be checked before saving, auto_now fields change on save
+        if not kwargs.pop('force_remote', False) and self.remote_changes() == []:
+            self._skip_remote()
+            return super(RemoteAtomic, self).save(*args, **kwargs)
+        if getattr(settings, 'CCOMMANDER_OUTBOX', False):
+            return self.save_deferred(*args, **kwargs)
         with transaction.commit_on_success(using='ccommander_app'):
             _save = super(RemoteAtomic, self).save
             _save(*args, **kwargs)
@@ -27,6 +136,18 @@ class RemoteAtomic(object):
                 self.remote_id = result
                 kwargs.update({'force_insert': False})
                 _save(*args, **kwargs)
+        self._remote_pushed()
+
+    def save_deferred(self, *args, **kwargs):
+        """Saves the model and queues the remote write in the outbox, both in
+        the same transaction
+        """
+        with transaction.commit_on_success(using='ccommander_app'):
+            super(RemoteAtomic, self).save(*args, **kwargs)
+            PendingSync.objects.create(
+                model='%s.%s' % (self._meta.app_label, self._meta.object_name),
+                object_id=self.pk)
+        self._remote_pushed()
 
     def delete(self, *args, **kwargs):
         with transaction.commit_on_success():
@@ -232,6 +353,28 @@ class Segment(RemoteAtomic, models.Model):
     def __unicode__(self):
         return self.name
 
+    def push_criteria(self, concurrency=None):
+        """Pushes every criteria of the segment to the remote at once
+
+        It replaces the push of each criteria on save, so the criteria must
+        have been saved with save(push=False), otherwise they are pushed
+        twice and duplicated remotely:
+
+            for criteria in criterias:
+                criteria.save(push=False)
+            failures = segment.push_criteria()
+
+        Returns the failed criteria, see SegmentRemote.save_criteria
+        """
+        criteria = (list(self.criteria_set.all()) +
+                    list(self.numericcriteria_set.all()))
+        failures = self._remote.save_criteria(criteria, concurrency)
+        failed = set(id(c) for c, e in failures)
+        for c in criteria:
+            if id(c) not in failed:
+                c._remote_pushed()
+        return failures
+
 
 class Criteria(RemoteAtomic, models.Model):
     """Campaign Commander Segment Criteria
@@ -276,6 +419,7 @@ class Criteria(RemoteAtomic, models.Model):
                                             'link, recency, and social criteria: '
                                             'Operator'))
     values = StringListField(_('Values'), blank=True, internal_type='TextField',
+                            storage=StringListField.DELIMITED,
                             help_text=_('Demographic aphanumeric (string) '
                                         'and date criteria parameter: '
                                         'The values to which the operator '
@@ -295,6 +439,38 @@ class Criteria(RemoteAtomic, models.Model):
         return "%s %s %s" % (self.column_name, self.operator, self.values)
 
 
+class CriteriaValue(models.Model):
+    """A single value of a Criteria, indexed
+
+    Kept in sync with Criteria.values so the criteria targeting a value can
+    be found with an index lookup:
+
+        Criteria.objects.filter(indexed_values__value='email1@mail.com')
+    """
+    criteria = models.ForeignKey(Criteria, related_name='indexed_values')
+    value = models.CharField(_('Value'), max_length=255, db_index=True)
+
+    class Meta:
+        verbose_name = _('Criteria value')
+        verbose_name_plural = _('Criteria values')
+
+    def __unicode__(self):
+        return self.value
+
+
+def index_criteria_values(sender, instance, created, **kwargs):
+    values = instance.values
+    if not created and isinstance(values, LazyStringList) and not values.decoded:
+        # not even read since it was loaded
+        return
+    CriteriaValue.objects.filter(criteria=instance).delete()
+    CriteriaValue.objects.bulk_create([
+        CriteriaValue(criteria=instance, value=value[:255])
+        for value in set(values)])
+
+models.signals.post_save.connect(index_criteria_values, sender=Criteria)
+
+
 class NumericCriteria(RemoteAtomic, models.Model):
     """Campaign Commander Segment Numeric Criteria
 
@@ -486,11 +662,73 @@ class Campaign(RemoteAtomic, models.Model):
     def post(self):
         self._remote.post(self)
 
+    def remote_status(self):
+        """Returns the status of the campaign in Campaign Commander, read
+        through the read cache
+        """
+        return self._remote.status(self.remote_id)
+
+
+class MemberQuerySet(models.query.QuerySet):
 
-class Member(models.Model):
+    def sync_remote(self, chunk_size=None):
+        """Pushes every member in the queryset to the remote in chunks
+
+        Returns a list of (member, exception) tuples with the failed members
+        """
+        return self.model._remote.save_many(self.iterator(), chunk_size)
+
+    def rejoin(self, concurrency=None):
+        """Rejoins every member of the queryset and marks them as active
+
+        Returns a tuple (emails, failures) with the rejoined emails and a
+        list of (email, exception) tuples with the failed ones
+        """
+        return self._set_membership(self.model._remote.rejoin_many, True,
+                                    concurrency)
+
+    def unjoin(self, concurrency=None):
+        """Unjoins every member of the queryset and marks them as inactive,
+        see rejoin
+        """
+        return self._set_membership(self.model._remote.unjoin_many, False,
+                                    concurrency)
+
+    def _set_membership(self, call_many, is_active, concurrency):
+        pks = {}
+        for pk, email in self.values_list('pk', 'email').iterator():
+            pks.setdefault(email, []).append(pk)
+        failures = call_many(pks.keys(), concurrency)
+        failed = set(email for email, e in failures)
+        emails = [email for email in pks if email not in failed]
+        # in batches, SQLite takes up to 999 variables per query
+        for chunk in chunked((pk for email in emails for pk in pks[email]),
+                             500):
+            self.model._default_manager.filter(pk__in=chunk).update(
+                is_active=is_active)
+        return emails, failures
+
+
+class MemberManager(models.Manager):
+
+    def get_query_set(self):
+        return MemberQuerySet(self.model, using=self._db)
+
+    def sync_remote(self, queryset=None, chunk_size=None):
+        """Pushes the members in queryset (all of them by default) to the
+        remote. See MemberQuerySet.sync_remote
+        """
+        if queryset is None:
+            queryset = self.get_query_set()
+        return self.model._remote.save_many(queryset.iterator(), chunk_size)
+
+
+class Member(RemoteTracking, models.Model):
     """Campaign Commander Member
 
     Users registered in the database
+
+    >>> failures = Member.objects.sync_remote(Member.objects.filter(is_active=True))
     """
     email = models.EmailField(_('Email'), db_index=True)
     firstname = models.CharField(_('First name'), max_length=45,
@@ -529,6 +767,8 @@ class Member(models.Model):
     company_city_id = models.IntegerField(_('Company city ID'),
                                           null=True, blank=True)
 
+    objects = MemberManager()
+
     class Meta:
         verbose_name = _('Member')
         verbose_name_plural = _('Members')
@@ -545,8 +785,21 @@ class Member(models.Model):
         self._remote.unjoin(self)
 
     def save(self, *args, **kwargs):
+        """Saves the member and pushes the changed fields to the remote
+
+        Nothing is pushed when no field changed since the last push, unless
+        force_remote=True is given
+        """
+        if kwargs.pop('force_remote', False):
+            changes = None
+        else:
+            changes = self.remote_changes()
         result = super(Member, self).save(*args, **kwargs)
-        self._remote.save(self)
+        if changes == []:
+            self._skip_remote()
+        else:
+            self._remote.save(self, changes)
+            self._remote_pushed()
         return result
 
     def delete(self, *args, **kwargs):
@@ -554,6 +807,6 @@ class Member(models.Model):
         # We don't remove the remote object (because we can't), we simple set it
         # as inactive
         self.is_active = False
-        self._remote.save(self)
+        self._remote.save(self, ['is_active'])
         return result
 
@@ -0,0 +1,122 @@
+"""Dispatcher of the remote writes queued in the outbox
+
+With CCOMMANDER_OUTBOX enabled, RemoteAtomic.save commits the model row
+together with a PendingSync record and returns without talking to Campaign
+Commander. ``dispatch`` pushes those records in order and writes the
+``remote_id`` returned by the remote back into the row.
+
+A failed write is tried again after an exponential backoff. Failures
+meaning Campaign Commander can't be reached (network errors, an open
+circuit) are only retried, the ones where it rejected the write count
+towards parking it (see parked).
+
+It's meant to be run by a single process, see the outbox-dispatcher
+management command.
+"""
+import datetime
+
+from django.conf import settings
+from django.utils.log import getLogger, NullHandler
+
+from ccommander.models import PendingSync
+from ccommander.resilience import CircuitOpenError, transient_errors
+
+logger = getLogger('ccommander.outbox')
+if not logger.handlers:
+    logger.addHandler(NullHandler())
+
+
+def max_attempts():
+    return getattr(settings, 'CCOMMANDER_OUTBOX_MAX_ATTEMPTS', 10)
+
+
+def parked():
+    """Returns the writes rejected CCOMMANDER_OUTBOX_MAX_ATTEMPTS times,
+    they are left in the outbox but no longer pushed
+    """
+    return PendingSync.objects.filter(attempts__gte=max_attempts())
+
+
+def retry_delay(retries):
+    """Returns the seconds to wait before trying a write again after the
+    given number of consecutive failures
+    """
+    delay = getattr(settings, 'CCOMMANDER_OUTBOX_RETRY_DELAY', 1)
+    max_delay = getattr(settings, 'CCOMMANDER_OUTBOX_MAX_RETRY_DELAY', 300)
+    return min(max_delay, delay * 2 ** (retries - 1))
+
+
+def is_unavailable(error):
+    """Returns whether error means the remote couldn't be reached"""
+    return isinstance(error, (CircuitOpenError,) + transient_errors())
+
+
+def _failed(pending, error):
+    """Records a failed push of pending, returns whether it got parked"""
+    pending.retries += 1
+    if not is_unavailable(error):
+        pending.attempts += 1
+    pending.retry_at = datetime.datetime.now() + datetime.timedelta(
+        seconds=retry_delay(pending.retries))
+    pending.last_error = unicode(error)
+    pending.save()
+    return pending.attempts >= max_attempts()
+
+
+def dispatch(limit=100):
+    """Pushes up to limit pending writes to the remote
+
+    Writes are pushed in the order they were queued and the dispatch stops at
+    the first failure, or at the first write still waiting for its retry,
+    since later writes may depend on it (a criteria needs the remote_id of
+    its segment). A write rejected for the CCOMMANDER_OUTBOX_MAX_ATTEMPTS
+    time is parked instead so it can't block the outbox. Returns the number
+    of writes pushed.
+    """
+    now = datetime.datetime.now()
+    batch = list(PendingSync.objects.filter(attempts__lt=max_attempts())
+                 [:limit])
+    # the row is loaded after the batch, so one push covers every write of
+    # the row in it; writes queued later are pushed by the next dispatch
+    last = {}
+    for pending in batch:
+        last[(pending.model, pending.object_id)] = pending.pk
+    handled = set()
+    pushed = 0
+    for pending in batch:
+        key = (pending.model, pending.object_id)
+        if key in handled:
+            continue
+        if pending.retry_at is not None and pending.retry_at > now:
+            break
+        model = pending.get_model()
+        try:
+            instance = model._default_manager.get(pk=pending.object_id)
+        except model.DoesNotExist:
+            PendingSync.objects.filter(model=pending.model,
+                                       object_id=pending.object_id,
+                                       pk__lte=last[key]).delete()
+            handled.add(key)
+            continue
+
+        try:
+            result = instance._remote.save(instance)
+        except Exception, e:
+            logger.error(e)
+            if not _failed(pending, e):
+                break
+            logger.error('Parked %s after %d attempts', pending,
+                         pending.attempts)
+            handled.add(key)
+            continue
+
+        if hasattr(instance, 'remote_id'):
+            # update() instead of save() to not queue the row again
+            model._default_manager.filter(pk=instance.pk).update(
+                remote_id=result)
+        PendingSync.objects.filter(model=pending.model,
+                                   object_id=pending.object_id,
+                                   pk__lte=last[key]).delete()
+        handled.add(key)
+        pushed += 1
+    return pushed
@@ -0,0 +1,290 @@
+"""Process-wide pool of SOAP clients and Campaign Commander API sessions
+
+Building a ``suds.client.Client`` downloads and parses the WSDL, and every
+API session costs an ``openApiConnection`` and a ``closeApiConnection`` round
+trip. The pools in this module parse each WSDL once per process and keep a
+bounded set of open session tokens that callers borrow and give back.
+
+>>> pool = get_pool(settings.CCOMMANDER_API_MEMBER_UPDATE_WSDL)
+>>> with pool.connection() as (client, con):
+...     client.service.rejoinMemberByEmail(con, 'member@mail.com')
+
+Expiry is guessed from the idle and age timers of the sessions, but the
+remote can drop a token earlier. When a call fails with a fault saying so
+(see CCOMMANDER_SESSION_FAULTS) the borrowed session gets a new token and
+the call is made once more with it.
+"""
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from ccommander import metrics
+from ccommander.envelopes import get_serializer
+from ccommander.ratelimit import get_limiter
+from ccommander.resilience import ResilientClient, get_breaker
+from ccommander.transports import get_transport
+
+
+SESSION_FAULTS = ('session', 'token')
+
+
+def is_invalid_session(error):
+    """Returns whether error is a fault of the remote rejecting the session
+    token, told by the patterns of CCOMMANDER_SESSION_FAULTS
+    """
+    if getattr(error, 'fault', None) is None:
+        return False
+    text = unicode(error).lower()
+    return any(pattern.lower() in text for pattern in
+               getattr(settings, 'CCOMMANDER_SESSION_FAULTS', SESSION_FAULTS))
+
+
+class Session(object):
+    """An open API session, the token returned by openApiConnection"""
+
+    def __init__(self, token):
+        self.token = token
+        self.created_at = self.last_used = time.time()
+        # tokens this session had before being renewed
+        self.replaced = set()
+
+    def is_expired(self, idle_timeout, max_age, now=None):
+        now = now or time.time()
+        return (now - self.last_used > idle_timeout or
+                now - self.created_at > max_age)
+
+
+class SessionService(object):
+    """Proxy of client.service renewing the token of a borrowed session
+    rejected by the remote, and retrying the call once with the new one
+
+    Calls are expected to take the token as their first argument. Calls
+    given an envelope of the fast serializer (see ccommander.remotes.soap_call)
+    along with their arguments get their envelope rendered again.
+    """
+
+    def __init__(self, client, pool, session):
+        self._client = client
+        self._service = client.service
+        self._pool = pool
+        self._session = session
+
+    def __getattr__(self, name):
+        method = getattr(self._service, name)
+        if name in ('openApiConnection', 'closeApiConnection'):
+            return method
+        client, pool, session = self._client, self._pool, self._session
+
+        def call(*args, **kwargs):
+            if (args and isinstance(args[0], basestring) and
+                    args[0] in session.replaced):
+                args = (session.token,) + args[1:]
+            try:
+                return method(*args, **kwargs)
+            except Exception, e:
+                if not (args and args[0] == session.token and
+                        is_invalid_session(e)):
+                    raise
+            pool.renew(client, session)
+            args = (session.token,) + args[1:]
+            if '__inject' in kwargs:
+                envelope = get_serializer(client).render(name, *args)
+                kwargs = dict(kwargs, **{'__inject': {'msg': envelope}})
+            return method(*args, **kwargs)
+        return call
+
+
+class SessionClient(object):
+    """Proxy of a client whose service is a SessionService"""
+
+    def __init__(self, client, pool, session):
+        self._client = client
+        self.service = SessionService(client, pool, session)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class SessionPool(object):
+    """Pool of API sessions opened against a single WSDL
+
+    At most ``max_size`` sessions are borrowed at the same time, callers
+    asking for more wait until a session is given back. Sessions that have
+    been idle for more than ``idle_timeout`` seconds or that are older than
+    ``max_age`` seconds are considered expired by the remote and are closed
+    instead of being handed out again.
+    """
+
+    def __init__(self, wsdl, max_size=4, idle_timeout=600, max_age=3600):
+        self.wsdl = wsdl
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self._client = None
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_client(self):
+        """Returns a suds client for this pool's WSDL
+
+        The WSDL is only parsed the first time, afterwards a clone sharing the
+        parsed definitions is returned since suds clients are not thread safe.
+        Its service calls are retried and guarded by the circuit breaker of
+        the WSDL (see ccommander.resilience), and rate limited by family (see
+        ccommander.ratelimit).
+        """
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    with metrics.timer('remote.wsdl_fetch'):
+                        self._client = get_transport().get_client(
+                            self.wsdl)
+        return ResilientClient(self._client.clone(), get_breaker(self.wsdl),
+                               get_limiter(self.wsdl))
+
+    def _open(self, client):
+        token = client.service.openApiConnection(settings.CCOMMANDER_API_USER,
+                                                 settings.CCOMMANDER_API_PASSWORD,
+                                                 settings.CCOMMANDER_API_KEY)
+        return Session(token)
+
+    def renew(self, client, session):
+        """Gives a new token to a borrowed session the remote rejected"""
+        metrics.incr('pool.renewal')
+        stale = session.token
+        session.token = self._open(client).token
+        session.created_at = time.time()
+        session.replaced.add(stale)
+
+    def _close(self, client, session):
+        try:
+            client.service.closeApiConnection(session.token)
+        except Exception:
+            # the session is gone anyway, most likely it already expired
+            pass
+
+    def reap(self, client=None):
+        """Closes the idle sessions that have already expired"""
+        now = time.time()
+        with self._lock:
+            expired = [s for s in self._idle
+                       if s.is_expired(self.idle_timeout, self.max_age, now)]
+            self._idle = [s for s in self._idle if s not in expired]
+            self.evictions += len(expired)
+        if expired:
+            metrics.incr('pool.eviction', len(expired))
+            client = client or self.get_client()
+            for session in expired:
+                self._close(client, session)
+        return len(expired)
+
+    def acquire(self):
+        """Borrows a session, opening a new one if none is idle
+
+        Returns a tuple (client, session), the client renews the session
+        when the remote rejects its token (see SessionService)
+        """
+        self._slots.acquire()
+        try:
+            client = self.get_client()
+            self.reap(client)
+            with self._lock:
+                session = self._idle.pop() if self._idle else None
+                if session is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            metrics.incr('pool.miss' if session is None else 'pool.hit')
+            if session is None:
+                session = self._open(client)
+            return SessionClient(client, self, session), session
+        except:
+            self._slots.release()
+            raise
+
+    def release(self, session):
+        """Gives back a borrowed session so it can be reused"""
+        session.last_used = time.time()
+        with self._lock:
+            self._idle.append(session)
+        self._slots.release()
+
+    def discard(self, client, session):
+        """Closes a borrowed session instead of giving it back"""
+        try:
+            self._close(client, session)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Yields a tuple (client, token) with a borrowed session
+
+        A session that saw an error is closed rather than given back, since
+        we can't tell whether the fault was caused by an expired token.
+        """
+        client, session = self.acquire()
+        try:
+            yield client, session.token
+        except:
+            self.discard(client, session)
+            raise
+        else:
+            self.release(session)
+
+    def close(self):
+        """Closes every idle session"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        if idle:
+            client = self.get_client()
+            for session in idle:
+                self._close(client, session)
+
+    def stats(self):
+        with self._lock:
+            return {'wsdl': self.wsdl,
+                    'idle': len(self._idle),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(wsdl):
+    """Returns the process-wide session pool for the given WSDL"""
+    pool = _pools.get(wsdl)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(wsdl)
+            if pool is None:
+                pool = SessionPool(
+                    wsdl,
+                    max_size=getattr(settings, 'CCOMMANDER_POOL_SIZE', 4),
+                    idle_timeout=getattr(settings,
+                                         'CCOMMANDER_POOL_IDLE_TIMEOUT', 600),
+                    max_age=getattr(settings, 'CCOMMANDER_POOL_MAX_AGE', 3600))
+                _pools[wsdl] = pool
+    return pool
+
+
+def stats():
+    """Returns the counters of every pool in this process"""
+    return [pool.stats() for pool in _pools.values()]
+
+
+@atexit.register
+def close_all():
+    """Closes the idle sessions of every pool in this process"""
+    for pool in _pools.values():
+        pool.close()
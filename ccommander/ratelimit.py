@@ -0,0 +1,172 @@
+"""Token bucket rate limiting of the calls to Campaign Commander
+
+Campaign Commander enforces call quotas per account, so every call made
+through the session pools takes a token from the bucket of its operation
+family first, waiting for one when the bucket is empty:
+
+    CCOMMANDER_RATE_LIMITS = {
+        # family: (calls per second, burst)
+        'member': (20, 40),
+        'campaign-management': (5, 10),
+        'notification': (50, 50),
+    }
+    CCOMMANDER_RATE_LIMIT_DB = '/var/run/ccommander/ratelimit.sqlite'
+
+The families are the member, campaign management and notification WSDLs.
+Buckets live in memory, so each process gets the whole quota, unless
+CCOMMANDER_RATE_LIMIT_DB names a SQLite file: it's then shared by every
+process of the host (rpc-server workers, commands, web workers) under its
+write lock.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+from ccommander import metrics
+
+FAMILIES = (
+    ('CCOMMANDER_API_MEMBER_UPDATE_WSDL', 'member'),
+    ('CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL', 'campaign-management'),
+    ('CCOMMANDER_API_NOTIFICATION_WSDL', 'notification'),
+)
+
+
+def family_of(wsdl):
+    """Returns the operation family of the WSDL url"""
+    for setting, family in FAMILIES:
+        if getattr(settings, setting, None) == wsdl:
+            return family
+    return wsdl
+
+
+def _take(tokens, updated, now, rate, burst):
+    """Refills a bucket last updated at updated and takes a token from it
+
+    Returns a tuple with the tokens left and 0 when a token was taken, or
+    the seconds to wait for the next one.
+    """
+    if tokens is None:
+        tokens = float(burst)
+    else:
+        tokens = min(float(burst), tokens + max(0, now - updated) * rate)
+    # rounding errors shouldn't make callers wait for nothing
+    if tokens >= 1 - 1e-6:
+        return max(0.0, tokens - 1), 0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryStore(object):
+    """Buckets of this process"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, name, rate, burst, now):
+        """Takes a token from the bucket name, returns 0 when it got one or
+        the seconds to wait for the next one
+        """
+        with self._lock:
+            tokens, updated = self._buckets.get(name, (None, now))
+            tokens, wait = _take(tokens, updated, now, rate, burst)
+            self._buckets[name] = (tokens, now)
+            return wait
+
+
+class SQLiteStore(object):
+    """Buckets shared by the processes using the same SQLite file"""
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, '
+            'tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    def _connect(self):
+        # sqlite connections can't be shared between threads
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = self._local.con = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None)
+        return con
+
+    def take(self, name, rate, burst, now):
+        """See MemoryStore.take"""
+        con = self._connect()
+        # takes the write lock of the file until the commit
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            row = con.execute('SELECT tokens, updated FROM buckets '
+                              'WHERE name = ?', (name,)).fetchone()
+            tokens, wait = _take(row and row[0], row and row[1], now, rate,
+                                 burst)
+            con.execute('INSERT OR REPLACE INTO buckets (name, tokens, '
+                        'updated) VALUES (?, ?, ?)', (name, tokens, now))
+        except:
+            con.execute('ROLLBACK')
+            raise
+        con.execute('COMMIT')
+        return wait
+
+
+class RateLimiter(object):
+    """Token bucket of rate tokens per second holding up to burst tokens"""
+
+    def __init__(self, name, rate, burst=None, store=None):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.store = store or MemoryStore()
+
+    def acquire(self):
+        """Waits until a token is available and takes it"""
+        waited = 0
+        while True:
+            wait = self.store.take(self.name, self.rate, self.burst,
+                                   time.time())
+            if not wait:
+                break
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            metrics.timing('ratelimit.wait.%s' % self.name, waited)
+
+
+_limiters = {}
+_store = None
+_lock = threading.Lock()
+
+
+def _get_store():
+    global _store
+    if _store is None:
+        path = getattr(settings, 'CCOMMANDER_RATE_LIMIT_DB', None)
+        _store = SQLiteStore(path) if path else MemoryStore()
+    return _store
+
+
+def get_limiter(wsdl):
+    """Returns the process-wide limiter of the family of the WSDL url, None
+    if its calls are not limited
+    """
+    family = family_of(wsdl)
+    if family not in _limiters:
+        with _lock:
+            if family not in _limiters:
+                limit = getattr(settings, 'CCOMMANDER_RATE_LIMITS',
+                                {}).get(family)
+                if limit is None:
+                    _limiters[family] = None
+                else:
+                    rate, burst = limit
+                    _limiters[family] = RateLimiter(family, rate, burst,
+                                                    _get_store())
+    return _limiters[family]
@@ -0,0 +1,194 @@
+"""Incremental reconciliation of the local rows with Campaign Commander
+
+Instead of pulling every message, segment and campaign, ``reconcile`` only
+asks the remote for the objects of the period since the watermark stored for
+the model (a SyncWatermark), matches them with the local rows by
+``remote_id`` and applies the differences in bulk:
+
+>>> for report in reconcile(dry_run=True):
+...     print report
+
+The API limits how incremental this can be:
+
+- messages and campaigns are listed by creation date (getMessagesByPeriod,
+  getCampaignsByPeriod), so only new ones are pulled, later edits of
+  existing ones are only picked up by a full reconciliation (full=True,
+  --full in the command).
+- segments are listed by modification date, but the list can't be filtered
+  remotely, every run pages through all of them.
+
+Objects that can't be applied yet (a campaign whose message or segment is
+not local) are skipped and the watermark is left where it was, so the next
+run pulls them again.
+
+Remote objects are mapped back with the same field metadata used to push
+them (see ccommander.mappers.deserialize), related objects are looked up by
+their remote_id. Rows are written with bulk_create and update(), so nothing
+is pushed back to the remote.
+
+It's run by the ccommander_reconcile management command and can be queued
+to the rpc-server as api.reconcile_remote.
+"""
+import datetime
+
+from django.db import router, transaction
+from django.db.models import ForeignKey
+from django.db.models.fields import FieldDoesNotExist
+from django.utils.log import getLogger, NullHandler
+
+from ccommander import metrics
+from ccommander.mappers import deserialize
+from ccommander.models import Message, Segment, Campaign, SyncWatermark
+from ccommander.remotes import chunked
+
+logger = getLogger('ccommander.reconcile')
+if not logger.handlers:
+    logger.addHandler(NullHandler())
+
+
+# in dependency order, campaigns point to messages and segments
+MODELS = (Message, Segment, Campaign)
+
+# where a full pull starts
+EPOCH = datetime.datetime(2000, 1, 1)
+
+
+class Report(object):
+    """What a reconciliation of a model did (or would do on a dry run)
+
+    created and updated hold the remote ids of the rows, changes maps the
+    remote ids of the updated rows to the names of their changed fields and
+    skipped maps remote ids to the reason they couldn't be applied.
+    """
+
+    def __init__(self, model, since, until, dry_run):
+        self.model = model
+        self.since = since
+        self.until = until
+        self.dry_run = dry_run
+        self.created = []
+        self.updated = []
+        self.unchanged = 0
+        self.changes = {}
+        self.skipped = {}
+
+    def __unicode__(self):
+        return u"%s%s since %s: %d created, %d updated, %d unchanged, " \
+               u"%d skipped" % ('[dry run] ' if self.dry_run else '',
+                                self.model._meta.verbose_name_plural,
+                                self.since, len(self.created),
+                                len(self.updated), self.unchanged,
+                                len(self.skipped))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+def _label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+def _remote_ids(model, remote_ids):
+    """Returns a dict mapping the given remote ids to the local rows"""
+    rows = {}
+    for chunk in chunked(remote_ids, 500):
+        for row in model._default_manager.filter(remote_id__in=chunk):
+            rows[row.remote_id] = row
+    return rows
+
+
+def _has_remote_id(model):
+    try:
+        model._meta.get_field('remote_id')
+    except FieldDoesNotExist:
+        return False
+    return True
+
+
+def _related_fields(model):
+    """Returns the foreign keys of model mapped to a remote id"""
+    return [field for field in model._meta.fields
+            if isinstance(field, ForeignKey) and
+            hasattr(field, 'remote_name') and
+            _has_remote_id(field.rel.to)]
+
+
+def reconcile_model(model, dry_run=False, full=False, until=None):
+    """Reconciles the remote objects of model modified since its watermark
+
+    With full=True the watermark is ignored and every remote object is
+    pulled. The watermark doesn't move when objects were skipped. Nothing
+    is written on a dry run, not even the watermark. Returns a Report.
+    """
+    watermark, _ = SyncWatermark.objects.get_or_create(model=_label(model))
+    since = EPOCH if full else watermark.synced_until or EPOCH
+    until = until or datetime.datetime.now()
+    report = Report(model, since, until, dry_run)
+
+    with metrics.timer('reconcile.fetch.%s' % model.__name__):
+        remote_objects = model._remote.modified_since(since, until)
+
+    related = _related_fields(model)
+    related_ids = dict(
+        (field.name, _remote_ids(field.rel.to,
+                                 set(getattr(o, field.remote_name, None)
+                                     for o in remote_objects)))
+        for field in related)
+
+    incoming = {}
+    for remote_object in remote_objects:
+        values = deserialize(remote_object, model)
+        remote_id = values.get('remote_id')
+        if remote_id is None:
+            continue
+        for field in related:
+            row = related_ids[field.name].get(
+                getattr(remote_object, field.remote_name, None))
+            if row is None:
+                report.skipped[remote_id] = 'unknown %s' % field.name
+                break
+            values[field.attname] = row.pk
+        else:
+            incoming[remote_id] = values
+
+    existing = _remote_ids(model, incoming.keys())
+    created, updated = [], []
+    for remote_id, values in incoming.items():
+        row = existing.get(remote_id)
+        if row is None:
+            created.append(model(**values))
+            report.created.append(remote_id)
+            continue
+        changed = dict((name, value) for name, value in values.items()
+                       if getattr(row, name) != value)
+        if changed:
+            updated.append((row.pk, changed))
+            report.updated.append(remote_id)
+            report.changes[remote_id] = sorted(changed)
+        else:
+            report.unchanged += 1
+
+    if dry_run:
+        return report
+
+    with transaction.commit_on_success(using=router.db_for_write(model)):
+        model._default_manager.bulk_create(created)
+        for pk, changed in updated:
+            model._default_manager.filter(pk=pk).update(**changed)
+        if not report.skipped:
+            watermark.synced_until = until
+        watermark.synced_at = datetime.datetime.now()
+        watermark.save()
+    metrics.incr('reconcile.created', len(created))
+    metrics.incr('reconcile.updated', len(updated))
+    if report.skipped:
+        logger.warning('%d remote %s skipped, they will be pulled again: %r',
+                       len(report.skipped), model._meta.verbose_name_plural,
+                       report.skipped)
+    return report
+
+
+def reconcile(models=MODELS, dry_run=False, full=False):
+    """Reconciles the given models in order, returns a list of Reports"""
+    until = datetime.datetime.now()
+    return [reconcile_model(model, dry_run, full, until) for model in models]
@@ -1,103 +1,300 @@
+import itertools
+import threading
+from collections import OrderedDict
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
-import suds
 from django.conf import settings
 
+from ccommander import metrics
+from ccommander.cache import get_read_cache
+from ccommander.envelopes import get_serializer
+from ccommander.mappers import DELETE, serialize
+from ccommander.pool import get_pool
 
-# Just an special attribute to detect when you want to remove attributes
-# from the object sent through SOAP, ex: the id attribute in an apiMessage
-# that is being created is meaningless, so you want to delete it if it's None
-# del apimessage.id
-DELETE = '_delete_'
+
+def chunked(iterable, size):
+    """Yields lists of at most size items taken from iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def soap_object(client, type_name):
+    """Returns a new object of the SOAP type type_name, a light Record
+    when CCOMMANDER_FAST_SERIALIZER is enabled (see ccommander.envelopes)
+    """
+    if getattr(settings, 'CCOMMANDER_FAST_SERIALIZER', False):
+        return get_serializer(client).create(type_name)
+    return client.factory.create(type_name)
+
+
+def soap_call(client, operation, *args):
+    """Calls the SOAP operation, its envelope is written by the fast
+    serializer when CCOMMANDER_FAST_SERIALIZER is enabled
+    """
+    method = getattr(client.service, operation)
+    if getattr(settings, 'CCOMMANDER_FAST_SERIALIZER', False):
+        envelope = get_serializer(client).render(operation, *args)
+        # the arguments are ignored by suds, they let the session pool
+        # render the envelope again with a renewed token
+        return method(*args, **{'__inject': {'msg': envelope}})
+    return method(*args)
+
+
+def plain(value):
+    """Converts suds objects (recursively) into dicts, so they can be cached
+    by any backend
+    """
+    if hasattr(value, '__keylist__'):
+        return dict((key, plain(getattr(value, key)))
+                    for key in value.__keylist__)
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    return value
+
+
+_bound = threading.local()
+
+
+@contextmanager
+def bind_connection(wsdl, client, con):
+    """Makes the remotes of wsdl reuse the given connection in this thread
+    instead of borrowing one from the pool
+    """
+    if not hasattr(_bound, 'connections'):
+        _bound.connections = {}
+    previous = _bound.connections.get(wsdl)
+    _bound.connections[wsdl] = (client, con)
+    try:
+        yield client, con
+    finally:
+        if previous is None:
+            del _bound.connections[wsdl]
+        else:
+            _bound.connections[wsdl] = previous
 
 
 class Remote(object):
     """Manages communication with the remote database through a SOAP
     webservice
+
+    The URL of the WSDL is read from the setting named wsdl_setting when
+    it's first needed. Reads go through the read cache (see
+    ccommander.cache) under keys starting with cache_prefix, and writes
+    invalidate the keys of the objects they change.
     """
+    wsdl_setting = None
+    cache_prefix = None
+
+    @property
+    def wsdl(self):
+        return getattr(settings, self.wsdl_setting)
+
     @contextmanager
     def get_connection(self):
-        client = suds.client.Client(self.wsdl)
-        con = client.service.openApiConnection(settings.CCOMMANDER_API_USER,
-                                               settings.CCOMMANDER_API_PASSWORD,
-                                               settings.CCOMMANDER_API_KEY)
-        try:
-            yield client, con
-        finally:
-            client.service.closeApiConnection(con)
+        bound = getattr(_bound, 'connections', {}).get(self.wsdl)
+        with metrics.timer('remote.%s' % type(self).__name__):
+            if bound is not None:
+                yield bound
+            else:
+                with get_pool(self.wsdl).connection() as (client, con):
+                    yield client, con
+
+    def cached(self, key, load):
+        """Returns the value of key from the read cache, calling load to
+        fetch it from the remote when it's missing. None is never cached.
+        """
+        cache = get_read_cache()
+        if cache is None:
+            return load()
+        key = '%s:%s' % (self.cache_prefix, key)
+        value = cache.get(key)
+        if value is not None:
+            metrics.incr('readcache.hit')
+            return value
+        metrics.incr('readcache.miss')
+        value = load()
+        if value is not None:
+            cache.set(key, value)
+        return value
+
+    def invalidate(self, *keys):
+        """Drops keys from the read cache, None keys are ignored"""
+        cache = get_read_cache()
+        if cache is not None:
+            for key in keys:
+                if key is not None:
+                    cache.delete('%s:%s' % (self.cache_prefix, key))
 
 
 class MemberRemote(Remote):
     """Remote for Member model"""
 
-    wsdl = settings.CCOMMANDER_API_MEMBER_UPDATE_WSDL
+    wsdl_setting = 'CCOMMANDER_API_MEMBER_UPDATE_WSDL'
+    cache_prefix = 'member'
+
+    @property
+    def chunk_size(self):
+        return getattr(settings, 'CCOMMANDER_MEMBER_CHUNK_SIZE', 500)
+
+    def get(self, email):
+        """Returns a dict with the fields of the remote member (by their
+        upper case remote names), None if there's no member with the email
+        """
+        def load():
+            with self.get_connection() as (client, con):
+                found = client.service.getMemberByEmail(con, email)
+            if not isinstance(found, list):
+                found = [found] if found else []
+            if not found:
+                return None
+            return dict((entry.key, plain(entry.value))
+                        for entry in found[0].attributes.entry)
+        return self.cached(email, load)
+
+    def is_joined(self, email):
+        """Returns whether the remote member is joined, None if there's no
+        member with the email
+        """
+        member = self.get(email)
+        if member is None:
+            return None
+        return not member.get('DATEUNJOIN')
 
     def rejoin(self, member):
         with self.get_connection() as (client, con):
             client.service.rejoinMemberByEmail(con, member.email)
+        self.invalidate(member.email)
 
     def unjoin(self, member):
         with self.get_connection() as (client, con):
             client.service.unjoinMemberByEmail(con, member.email)
-
-    def save(self, member):
+        self.invalidate(member.email)
+
+    def rejoin_many(self, emails, concurrency=None):
+        """Rejoins many emails, see _call_many"""
+        return self._call_many('rejoinMemberByEmail', emails, concurrency)
+
+    def unjoin_many(self, emails, concurrency=None):
+        """Unjoins many emails, see _call_many"""
+        return self._call_many('unjoinMemberByEmail', emails, concurrency)
+
+    def _call_many(self, operation, emails, concurrency=None):
+        """Calls operation for every email
+
+        The emails are split in chunks handled by up to concurrency threads
+        (the size of the session pool by default), each chunk over one pooled
+        connection. Returns a list of (email, exception) tuples with the
+        emails that failed, every email of a chunk fails with the error of
+        its connection when it can't get one.
+        """
+        def call(chunk):
+            failures = []
+            try:
+                with self.get_connection() as (client, con):
+                    for email in chunk:
+                        try:
+                            getattr(client.service, operation)(con, email)
+                        except Exception, e:
+                            failures.append((email, e))
+            except Exception, e:
+                # no session (or an open circuit), the rest of the chunk
+                # wasn't sent
+                failed = set(email for email, error in failures)
+                failures.extend((email, e) for email in chunk
+                                if email not in failed)
+            self.invalidate(*chunk)
+            return failures
+
+        workers = ThreadPool(concurrency or
+                             getattr(settings, 'CCOMMANDER_POOL_SIZE', 4))
+        try:
+            return [failure for failures in
+                    workers.imap_unordered(call, chunked(emails,
+                                                         self.chunk_size))
+                    for failure in failures]
+        finally:
+            workers.close()
+
+    def _synchro_member(self, client, member, fields=None):
+        s = soap_object(client, 'synchroMember')
+        s.email = member.email
+        s.memberUID = 'email:%s' % member.email
+        entries = []
+        for field in member._meta.fields:
+            if field.primary_key: continue
+            if fields is not None and field.attname not in fields: continue
+            value = getattr(member, field.name)
+            if value is True:
+                value = 1
+            if value is False:
+                value = 0
+            if value is None:
+                value = ''
+            entries.append({'key': field.name.upper(), 'value': value})
+        s.dynContent.entry.extend(entries)
+        return s
+
+    def save(self, member, fields=None):
+        """Pushes the member, only the given fields if fields is not None"""
         with self.get_connection() as (client, con):
-            s = client.factory.create('synchroMember')
-            s.email = member.email
-            s.memberUID = 'email:%s' % member.email
-            entries = []
-            for field in member._meta.fields:
-                if field.primary_key: continue
-                value = getattr(member, field.name)
-                if value is True:
-                    value = 1
-                if value is False:
-                    value = 0
-                if value is None:
-                    value = ''
-                entries.append({'key': field.name.upper(), 'value': value})
-            s.dynContent.entry.extend(entries)
-
-            client.service.insertOrUpdateMemberByObj(con, s)
+            soap_call(client, 'insertOrUpdateMemberByObj', con,
+                      self._synchro_member(client, member, fields))
+        self.invalidate(member.email)
+
+    def save_many(self, members, chunk_size=None):
+        """Pushes many members sharing one connection per chunk
+
+        members can be any iterable (a queryset iterator for instance), it's
+        consumed chunk_size members at a time. A failing member doesn't abort
+        the rest, the returned list holds a (member, exception) tuple for
+        every member that couldn't be saved. Every member of a chunk fails
+        with the error of its connection when it can't get one.
+        """
+        failures = []
+        for chunk in chunked(members, chunk_size or self.chunk_size):
+            chunk_failures = []
+            try:
+                with self.get_connection() as (client, con):
+                    for member in chunk:
+                        try:
+                            soap_call(client, 'insertOrUpdateMemberByObj',
+                                      con, self._synchro_member(client, member))
+                        except Exception, e:
+                            chunk_failures.append((member, e))
+            except Exception, e:
+                # no session (or an open circuit), the rest of the chunk
+                # wasn't sent
+                failed = set(id(member) for member, error in chunk_failures)
+                chunk_failures.extend((member, e) for member in chunk
+                                      if id(member) not in failed)
+            failures.extend(chunk_failures)
+            self.invalidate(*[member.email for member in chunk])
+        return failures
 
 
 class MessageRemote(Remote):
     """Remote for Message model"""
 
-    wsdl = settings.CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL
+    wsdl_setting = 'CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL'
 
     def save(self, message):
         with self.get_connection() as (client, con):
-            m = client.factory.create('apiMessage')
-            for field in message._meta.fields:
-                if field.primary_key:
-                    continue
-
-                field_name = field.name
-                if hasattr(field, 'remote_name'):
-                    remote_field_name = field.remote_name
-                else:
-                    remote_field_name = field_name
-
-                value = getattr(message, field_name)
-                # if model's field value is None, check for a default value in
-                # field.remote_default_value which it can be:
-                # a value (primitive python value)
-                # a callable which receives the api_message and the Message instance
-                # an special value DELETE to delete it
-                if value is None:
-                    if hasattr(field, 'remote_default_value'):
-                        value = field.remote_default_value
-                        if callable(value):
-                            value = value(m, message)
-                    else:
-                        value = ''
-
-                if value == DELETE:
-                    delattr(m, remote_field_name)
-                else:
-                    setattr(m, remote_field_name, value)
-            return client.service.createEmailMessageByObj(con, m)
+            m = soap_object(client, 'apiMessage')
+            serialize(message, m)
+            return soap_call(client, 'createEmailMessageByObj', con, m)
+
+    def modified_since(self, since, until):
+        """Returns the remote messages created between since and until, the
+        API can't list the ones modified
+        """
+        with self.get_connection() as (client, con):
+            ids = client.service.getMessagesByPeriod(con, since, until) or []
+            return [client.service.getMessage(con, id) for id in ids]
 
     def delete(self, message):
         assert False, _('Right now messages cannot be deleted')
@@ -106,40 +303,85 @@ class MessageRemote(Remote):
 class SegmentRemote(Remote):
     """Remote for Segment model"""
 
-    wsdl = settings.CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL
+    wsdl_setting = 'CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL'
+    cache_prefix = 'segment'
+
+    def get(self, remote_id):
+        """Returns a dict with the remote segment, None if it doesn't exist"""
+        def load():
+            with self.get_connection() as (client, con):
+                return plain(client.service.segmentationGetSegmentById(
+                    con, remote_id))
+        return self.cached(remote_id, load)
 
     def save(self, segment):
         with self.get_connection() as (client, con):
-            m = client.factory.create('apiSegmentation')
-            for field in segment._meta.fields:
-                if field.primary_key:
+            m = soap_object(client, 'apiSegmentation')
+            serialize(segment, m)
+            result = soap_call(client, 'segmentationCreateSegment', con, m)
+        self.invalidate(segment.remote_id)
+        return result
+
+    def modified_since(self, since, until, page_size=100):
+        """Returns the remote segments modified between since and until
+
+        The segment list can't be filtered by date, it's paged through
+        entirely and filtered by dateModif here.
+        """
+        segments = []
+        with self.get_connection() as (client, con):
+            for page in itertools.count(1):
+                found = client.service.segmentationGetSegmentList(
+                    con, page, page_size) or []
+                segments.extend(s for s in found
+                                if since <= s.dateModif < until)
+                if len(found) < page_size:
+                    return segments
+
+    def save_criteria(self, criteria, concurrency=None):
+        """Pushes many criteria (string and numeric) of a segment at once
+
+        Criteria are sorted by order_frag and grouped by group_number (or
+        group_name). Groups are pushed one after the other: the first
+        criteria of a group creates it so it goes alone, then the rest of
+        the group is pushed concurrently. Ungrouped criteria are pushed one
+        at a time, in order_frag order with the groups, since the remote
+        keeps them in the order they are added.
+
+        Returns a list of (criteria, exception) tuples with the failed
+        criteria, when the first criteria of a group fails the rest of the
+        group is not pushed and reported with the same exception.
+        """
+        def order(c):
+            return (c.order_frag is None, c.order_frag, c.pk)
+
+        groups = OrderedDict()
+        for i, c in enumerate(sorted(criteria, key=order)):
+            key = c.group_number if c.group_number is not None else c.group_name
+            # every ungrouped criteria in its own step
+            groups.setdefault(('ungrouped', i) if key is None else key,
+                              []).append(c)
+
+        def push(c):
+            try:
+                c._remote.save(c)
+            except Exception, e:
+                return c, e
+
+        failures = []
+        workers = ThreadPool(concurrency or
+                             getattr(settings, 'CCOMMANDER_POOL_SIZE', 4))
+        try:
+            for key, group in groups.items():
+                failure = push(group[0])
+                if failure:
+                    failures.append(failure)
+                    failures.extend((c, failure[1]) for c in group[1:])
                     continue
-
-                field_name = field.name
-                if hasattr(field, 'remote_name'):
-                    remote_field_name = field.remote_name
-                else:
-                    remote_field_name = field_name
-
-                value = getattr(segment, field_name)
-                # if model's field value is None, check for a default value in
-                # field.remote_default_value which it can be:
-                # a value (primitive python value)
-                # a callable which receives the api_message and the Segment instance
-                # an special value DELETE to delete it
-                if value is None:
-                    if hasattr(field, 'remote_default_value'):
-                        value = field.remote_default_value
-                        if callable(value):
-                            value = value(m, segment)
-                    else:
-                        value = ''
-
-                if value == DELETE:
-                    delattr(m, remote_field_name)
-                else:
-                    setattr(m, remote_field_name, value)
-            return client.service.segmentationCreateSegment(con, m)
+                failures.extend(f for f in workers.map(push, group[1:]) if f)
+        finally:
+            workers.close()
+        return failures
 
     def delete(self, segment):
         assert False, _('Right now segments cannot be deleted')
@@ -148,45 +390,16 @@ class SegmentRemote(Remote):
 class CriteriaRemote(Remote):
     """Remote for Criteria model"""
 
-    wsdl = settings.CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL
+    wsdl_setting = 'CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL'
+    cache_prefix = 'segment'
 
     def save(self, criteria):
         with self.get_connection() as (client, con):
-            m = client.factory.create('apiStringDemographicCriteria')
-            for field in criteria._meta.fields:
-                if field.primary_key:
-                    continue
-
-                field_name = field.name
-                if hasattr(field, 'remote_name'):
-                    remote_field_name = field.remote_name
-                else:
-                    remote_field_name = field_name
-
-                value = getattr(criteria, field_name)
-                # if model's field value is None, check for a default value in
-                # field.remote_default_value which it can be:
-                # a value (primitive python value)
-                # a callable which receives the api_message and the criteria instance
-                # an special value DELETE to delete it
-                if value is None:
-                    if hasattr(field, 'remote_default_value'):
-                        value = field.remote_default_value
-                        if callable(value):
-                            value = value(m, criteria)
-                    else:
-                        value = ''
-                elif hasattr(field, 'remote_value'):
-                    value = field.remote_value
-                    if callable(value):
-                        value = value(m, criteria)
-
-                if value == DELETE:
-                    delattr(m, remote_field_name)
-                else:
-                    setattr(m, remote_field_name, value)
-
-            client.service.segmentationAddStringDemographicCriteriaByObj(con, m)
+            m = soap_object(client, 'apiStringDemographicCriteria')
+            serialize(criteria, m)
+            soap_call(client, 'segmentationAddStringDemographicCriteriaByObj',
+                      con, m)
+        self.invalidate(criteria.segment.remote_id)
 
     def delete(self, criteria):
         assert False, _('Right now criterias cannot be deleted')
@@ -195,45 +408,16 @@ class CriteriaRemote(Remote):
 class NumericCriteriaRemote(Remote):
     """Remote for Criteria model"""
 
-    wsdl = settings.CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL
+    wsdl_setting = 'CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL'
+    cache_prefix = 'segment'
 
     def save(self, criteria):
         with self.get_connection() as (client, con):
-            m = client.factory.create('apiNumericDemographicCriteria')
-            for field in criteria._meta.fields:
-                if field.primary_key:
-                    continue
-
-                field_name = field.name
-                if hasattr(field, 'remote_name'):
-                    remote_field_name = field.remote_name
-                else:
-                    remote_field_name = field_name
-
-                value = getattr(criteria, field_name)
-                # if model's field value is None, check for a default value in
-                # field.remote_default_value which it can be:
-                # a value (primitive python value)
-                # a callable which receives the api_message and the criteria instance
-                # an special value DELETE to delete it
-                if value is None:
-                    if hasattr(field, 'remote_default_value'):
-                        value = field.remote_default_value
-                        if callable(value):
-                            value = value(m, criteria)
-                    else:
-                        value = ''
-                elif hasattr(field, 'remote_value'):
-                    value = field.remote_value
-                    if callable(value):
-                        value = value(m, criteria)
-
-                if value == DELETE:
-                    delattr(m, remote_field_name)
-                else:
-                    setattr(m, remote_field_name, value)
-
-            client.service.segmentationAddNumericDemographicCriteriaByObj(con, m)
+            m = soap_object(client, 'apiNumericDemographicCriteria')
+            serialize(criteria, m)
+            soap_call(client, 'segmentationAddNumericDemographicCriteriaByObj',
+                      con, m)
+        self.invalidate(criteria.segment.remote_id)
 
     def delete(self, criteria):
         assert False, _('Right now criterias cannot be deleted')
@@ -244,56 +428,55 @@ class CampaignRemote(Remote):
 
     class PostingError(Exception): pass
 
-    wsdl = settings.CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL
+    wsdl_setting = 'CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL'
+    cache_prefix = 'campaign'
+
+    def get(self, remote_id):
+        """Returns a dict with the remote campaign, None if it doesn't exist"""
+        def load():
+            with self.get_connection() as (client, con):
+                return plain(client.service.getCampaign(con, remote_id))
+        return self.cached(remote_id, load)
+
+    def status(self, remote_id):
+        """Returns the status of the remote campaign"""
+        def load():
+            with self.get_connection() as (client, con):
+                return client.service.getCampaignStatus(con, remote_id)
+        return self.cached('status:%s' % remote_id, load)
 
     def save(self, campaign):
         with self.get_connection() as (client, con):
-            m = client.factory.create('apiCampaign')
-            for field in campaign._meta.fields:
-                if field.primary_key:
-                    continue
-
-                field_name = field.name
-                if hasattr(field, 'remote_name'):
-                    remote_field_name = field.remote_name
-                else:
-                    remote_field_name = field_name
-
-                value = getattr(campaign, field_name)
-                # if model's field value is None, check for a default value in
-                # field.remote_default_value which it can be:
-                # a value (primitive python value)
-                # a callable which receives the api_message and the campaign instance
-                # an special value DELETE to delete it
-                if value is None:
-                    if hasattr(field, 'remote_default_value'):
-                        value = field.remote_default_value
-                        if callable(value):
-                            value = value(m, campaign)
-                    else:
-                        value = ''
-                elif hasattr(field, 'remote_value'):
-                    value = field.remote_value
-                    if callable(value):
-                        value = value(m, campaign)
-
-                if value == DELETE:
-                    delattr(m, remote_field_name)
-                else:
-                    setattr(m, remote_field_name, value)
-
-            return client.service.createCampaignByObj(con, m)
+            m = soap_object(client, 'apiCampaign')
+            serialize(campaign, m)
+            result = soap_call(client, 'createCampaignByObj', con, m)
+        self._invalidate_campaign(campaign.remote_id)
+        return result
+
+    def _invalidate_campaign(self, remote_id):
+        if remote_id is not None:
+            self.invalidate(remote_id, 'status:%s' % remote_id)
+
+    def modified_since(self, since, until):
+        """Returns the remote campaigns created between since and until, the
+        API can't list the ones modified
+        """
+        with self.get_connection() as (client, con):
+            return client.service.getCampaignsByPeriod(con, since, until) or []
 
     def post(self, campaign):
-        with self.get_connection() as (client, con):
-            if not client.service.postCampaign(con, campaign.remote_id):
-                raise CampaignRemote.PostingError()
+        try:
+            with self.get_connection() as (client, con):
+                if not client.service.postCampaign(con, campaign.remote_id):
+                    raise CampaignRemote.PostingError()
+        finally:
+            self._invalidate_campaign(campaign.remote_id)
 
 
 class LinkRemote(Remote):
     """Remote for Link model"""
 
-    wsdl = settings.CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL
+    wsdl_setting = 'CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL'
 
     def save(self, link):
         with self.get_connection() as (client, con):
@@ -304,7 +487,7 @@ class LinkRemote(Remote):
 class UnsubscribeLinkRemote(Remote):
     """Remote for UnsubscribeLink model"""
 
-    wsdl = settings.CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL
+    wsdl_setting = 'CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL'
 
     def save(self, link):
         with self.get_connection() as (client, con):
@@ -323,7 +506,7 @@ class UnsubscribeLinkRemote(Remote):
 class MirrorLinkRemote(Remote):
     """Remote for MirrorLink model"""
 
-    wsdl = settings.CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL
+    wsdl_setting = 'CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL'
 
     def save(self, link):
         with self.get_connection() as (client, con):
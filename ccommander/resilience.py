@@ -0,0 +1,230 @@
+"""Retries and circuit breaking around the SOAP calls
+
+Every ``client.service.*`` call made through a client handed out by the
+session pools goes through ``ResilientClient``: transient faults (network
+errors, HTTP errors from the transport) are retried with jittered
+exponential backoff, and after too many consecutive failures the circuit
+breaker of the WSDL opens and calls fail right away with CircuitOpenError
+until ``reset_timeout`` seconds have passed.
+
+Only idempotent operations are retried on any transient fault: the request
+of a timed out call may have been handled already, and replaying a create
+or a send would duplicate it. Other operations are only retried when the
+connection couldn't even be made (see IDEMPOTENT_OPERATIONS and
+CCOMMANDER_IDEMPOTENT_OPERATIONS).
+
+Faults returned by the remote (suds.WebFault) mean the remote is up, so they
+are neither retried nor counted by the breaker. Transient errors are the
+network ones plus the ones of the SOAP transport (see ccommander.transports).
+"""
+import errno
+import httplib
+import random
+import socket
+import threading
+import time
+import urllib2
+
+from django.conf import settings
+from django.utils.log import getLogger, NullHandler
+
+from ccommander import metrics
+from ccommander.transports import get_transport
+
+logger = getLogger('ccommander.resilience')
+if not logger.handlers:
+    logger.addHandler(NullHandler())
+
+
+TRANSIENT_ERRORS = (socket.error, urllib2.URLError, httplib.HTTPException)
+
+
+# errors raised before the request was sent
+CONNECT_ERRNOS = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH,
+                  errno.EHOSTDOWN)
+
+# operations that can be replayed safely, besides the ones reading (get*)
+IDEMPOTENT_OPERATIONS = (
+    'openApiConnection',
+    'closeApiConnection',
+    'insertOrUpdateMemberByObj',
+    'rejoinMemberByEmail',
+    'unjoinMemberByEmail',
+)
+
+
+def transient_errors():
+    """Returns the exceptions worth a retry, the transport's included"""
+    return TRANSIENT_ERRORS + get_transport().errors
+
+
+def is_idempotent(operation):
+    """Returns whether the SOAP operation can be called again safely"""
+    return (operation.startswith('get') or
+            operation.startswith('segmentationGet') or
+            operation in IDEMPOTENT_OPERATIONS or
+            operation in getattr(settings, 'CCOMMANDER_IDEMPOTENT_OPERATIONS',
+                                 ()))
+
+
+def is_connect_error(error):
+    """Returns whether error means the request never reached the remote"""
+    if isinstance(error, urllib2.URLError) and not isinstance(
+            error, urllib2.HTTPError):
+        error = error.reason
+    if isinstance(error, socket.gaierror):
+        return True
+    return (isinstance(error, socket.error) and
+            not isinstance(error, socket.timeout) and
+            error.errno in CONNECT_ERRNOS)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a remote that is known to be down"""
+
+
+class CircuitBreaker(object):
+    """Stops calling a remote after failure_threshold consecutive failures
+
+    After reset_timeout seconds one call is let through (half open), if it
+    succeeds the circuit closes again, otherwise it stays open.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.time() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(self.name)
+            # half open: let this call through, the next ones wait for it
+            self.opened_at = time.time()
+
+    def succeeded(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info('Circuit %s closed', self.name)
+            self.failures = 0
+            self.opened_at = None
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.error('Circuit %s opened after %d failures',
+                                 self.name, self.failures)
+                    metrics.incr('circuit.opened')
+                self.opened_at = time.time()
+
+    def call(self, func, *args, **kwargs):
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except transient_errors():
+            self.failed()
+            raise
+        self.succeeded()
+        return result
+
+
+def backoff(attempt, base_delay, max_delay):
+    """Returns the seconds to wait before the given retry (full jitter)"""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def retry(func, args=(), kwargs=None, attempts=3, base_delay=0.5,
+          max_delay=10, idempotent=True):
+    """Calls func retrying it on transient errors, only on connection errors
+    if it's not idempotent
+    """
+    kwargs = kwargs or {}
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except transient_errors(), e:
+            if attempt == attempts - 1 or not (idempotent or
+                                               is_connect_error(e)):
+                raise
+            metrics.incr('remote.retry')
+            time.sleep(backoff(attempt, base_delay, max_delay))
+
+
+class ResilientService(object):
+    """Proxy of client.service running every call through retry (see
+    is_idempotent) and the circuit breaker, every attempt waits for a token
+    of the rate limiter when there's one (see ccommander.ratelimit)
+    """
+
+    def __init__(self, service, breaker, limiter=None):
+        self._service = service
+        self._breaker = breaker
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        method = getattr(self._service, name)
+        breaker = self._breaker
+        metric = 'remote.call.%s' % name
+        idempotent = is_idempotent(name)
+        if self._limiter is not None:
+            method = self._limited(method)
+
+        def call(*args, **kwargs):
+            with metrics.timer(metric):
+                return retry(
+                    breaker.call, (method,) + args, kwargs,
+                    attempts=getattr(settings, 'CCOMMANDER_RETRY_ATTEMPTS', 3),
+                    base_delay=getattr(settings, 'CCOMMANDER_RETRY_DELAY', 0.5),
+                    max_delay=getattr(settings, 'CCOMMANDER_RETRY_MAX_DELAY', 10),
+                    idempotent=idempotent)
+        return call
+
+    def _limited(self, method):
+        limiter = self._limiter
+
+        def call(*args, **kwargs):
+            limiter.acquire()
+            return method(*args, **kwargs)
+        return call
+
+
+class ResilientClient(object):
+    """Proxy of a suds client whose service is a ResilientService"""
+
+    def __init__(self, client, breaker, limiter=None):
+        self._client = client
+        self.service = ResilientService(client.service, breaker, limiter)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """Returns the process-wide circuit breaker with the given name"""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    name,
+                    failure_threshold=getattr(
+                        settings, 'CCOMMANDER_CIRCUIT_FAILURES', 5),
+                    reset_timeout=getattr(
+                        settings, 'CCOMMANDER_CIRCUIT_RESET_TIMEOUT', 30))
+                _breakers[name] = breaker
+    return breaker
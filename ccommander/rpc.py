@@ -0,0 +1,131 @@
+"""Routing and scheduling of the requests of the rpc-server
+
+Requests can be spread over several queues (lanes), each with its own
+concurrency limit and a weight. RABITMQ_RPC_LANES in django settings
+describes the lanes and RABITMQ_RPC_ROUTES maps api methods to them:
+
+    RABITMQ_RPC_LANES = {
+        'transactional': {'queue': 'rpc.transactional', 'weight': 10,
+                          'concurrency': 8},
+        'bulk': {'queue': 'rpc.bulk', 'weight': 1, 'concurrency': 2},
+    }
+    RABITMQ_RPC_ROUTES = {
+        'send_transactional_email': 'transactional',
+        'sync_user': 'bulk',
+    }
+
+RABITMQ_RPC_QUEUE is always consumed as the 'default' lane. Producers should
+publish with ``publish`` (or to ``queue_for(method)``), but a request for a
+routed method received on another queue is still run in its lane.
+
+Ready requests wait in a backlog per lane. Whenever a worker is free the
+Scheduler picks the next one by smooth weighted round robin among the lanes
+below their concurrency limit, so a flood of bulk requests can't hold back
+the transactional ones.
+"""
+import json
+import threading
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+DEFAULT = 'default'
+
+
+class Lane(object):
+    """A queue consumed by the rpc-server and its share of the workers"""
+
+    def __init__(self, name, queue, weight=1, concurrency=1, prefetch=None):
+        self.name = name
+        self.queue = queue
+        self.weight = weight
+        self.concurrency = concurrency
+        self.prefetch = prefetch or concurrency * 2
+        self.backlog = deque()
+        self.in_flight = 0
+        self.current = 0
+
+    def __repr__(self):
+        return '<Lane %s: %d waiting, %d running>' % (
+            self.name, len(self.backlog), self.in_flight)
+
+
+def get_lanes(workers=1):
+    """Returns the configured lanes by name, the default one (with workers
+    as concurrency unless configured) first
+    """
+    lanes = OrderedDict()
+    configured = getattr(settings, 'RABITMQ_RPC_LANES', {})
+    options = dict({'concurrency': workers}, **configured.get(DEFAULT, {}))
+    options.setdefault('queue', settings.RABITMQ_RPC_QUEUE)
+    lanes[DEFAULT] = Lane(DEFAULT, **options)
+    for name, options in sorted(configured.items()):
+        if name != DEFAULT:
+            lanes[name] = Lane(name, **options)
+    return lanes
+
+
+def route(method):
+    """Returns the name of the lane of the api method, None if it's not
+    routed
+    """
+    return getattr(settings, 'RABITMQ_RPC_ROUTES', {}).get(method)
+
+
+def queue_for(method):
+    """Returns the queue where requests to the api method belong"""
+    lanes = getattr(settings, 'RABITMQ_RPC_LANES', {})
+    lane = lanes.get(route(method) or DEFAULT, {})
+    return lane.get('queue', settings.RABITMQ_RPC_QUEUE)
+
+
+def publish(channel, method, *args, **kwargs):
+    """Publishes a request to the api method on its queue through the given
+    pika channel
+    """
+    channel.basic_publish(exchange='', routing_key=queue_for(method),
+                          body=json.dumps({'method': method, 'args': args,
+                                           'kwargs': kwargs}))
+
+
+class Scheduler(object):
+    """Picks the requests to run from the backlogs of the lanes
+
+    It's shared by the connection thread and the worker threads, which call
+    done as soon as their request finishes.
+    """
+
+    def __init__(self, lanes):
+        self.lanes = lanes
+        self._lock = threading.Lock()
+
+    def add(self, lane, request):
+        with self._lock:
+            self.lanes[lane].backlog.append(request)
+
+    def next(self):
+        """Returns a tuple (lane, request) with the next request to run, or
+        None if every lane is empty or at its concurrency limit
+
+        Smooth weighted round robin: every ready lane earns its weight, the
+        richest one is picked and pays the total weight of the ready lanes.
+        """
+        with self._lock:
+            ready = [lane for lane in self.lanes.values()
+                     if lane.backlog and lane.in_flight < lane.concurrency]
+            if not ready:
+                return None
+            for lane in ready:
+                lane.current += lane.weight
+            picked = max(ready, key=lambda lane: lane.current)
+            picked.current -= sum(lane.weight for lane in ready)
+            picked.in_flight += 1
+            return picked.name, picked.backlog.popleft()
+
+    def done(self, lane):
+        with self._lock:
+            self.lanes[lane].in_flight -= 1
+
+    def pending(self):
+        with self._lock:
+            return sum(len(lane.backlog) for lane in self.lanes.values())
@@ -0,0 +1,99 @@
+"""Helpers to stream rows in and out of CSV and JSON lines files
+
+Used by the member import/export management commands, everything here works
+row by row so memory stays constant whatever the size of the file.
+"""
+import csv
+import json
+import os
+
+
+FORMATS = ('csv', 'jsonl')
+
+
+def guess_format(path, default='csv'):
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    if extension in ('jsonl', 'json', 'ndjson'):
+        return 'jsonl'
+    if extension == 'csv':
+        return 'csv'
+    return default
+
+
+def read_rows(f, format):
+    """Yields a dict per row of the open file f"""
+    if format == 'csv':
+        for row in csv.DictReader(f):
+            # short rows get None for their missing columns
+            yield dict((key, value if value is None else value.decode('utf-8'))
+                       for key, value in row.items() if key)
+    else:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class RowWriter(object):
+    """Writes dicts with the given fields as rows of the open file f"""
+
+    def __init__(self, f, format, fields, header=True):
+        self.f = f
+        self.format = format
+        self.fields = fields
+        if format == 'csv':
+            self.writer = csv.writer(f)
+            if header:
+                self.writer.writerow(fields)
+
+    def write(self, row):
+        if self.format == 'csv':
+            self.writer.writerow([_encode(row[field]) for field in self.fields])
+        else:
+            self.f.write(json.dumps(row, default=unicode) + '\n')
+
+
+def _encode(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class Checkpoint(object):
+    """Position of an interrupted import/export stored in a file, along with
+    any extra values the command needs to resume
+
+    The checkpoint is written to a temporary file which is then renamed, so a
+    crash never leaves a half written checkpoint.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, default=0):
+        """Returns the stored position, default if there's none"""
+        return self.load_state().get('position', default)
+
+    def load_state(self):
+        """Returns a dict with the position and the extra values stored"""
+        try:
+            with open(self.path) as f:
+                state = json.loads(f.read())
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(state, dict):
+            # a bare position
+            state = {'position': state}
+        return state
+
+    def save(self, position, **extra):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(extra, position=position), f)
+        os.rename(tmp, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
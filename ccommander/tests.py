@@ -164,3 +164,975 @@ class CampaignTest(TestCase):
 
         assert_that_method(Campaign._remote.save).was_called().with_args(campaign)
 
+
+
+class FakeService(object):
+
+    def __init__(self):
+        self.opened = 0
+        self.closed = 0
+
+    def openApiConnection(self, *args):
+        self.opened += 1
+        return 'token-%d' % self.opened
+
+    def closeApiConnection(self, token):
+        self.closed += 1
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.service = FakeService()
+
+    def clone(self):
+        return self
+
+
+class SessionPoolTest(TestCase):
+
+    def setUp(self):
+        from ccommander.pool import SessionPool
+        self.pool = SessionPool('http://wsdl', max_size=2, idle_timeout=60)
+        self.pool._client = FakeClient()
+
+    def test_sessions_are_reused(self):
+        """
+        Tests that a returned session is borrowed again instead of opening a
+        new one
+        """
+        with self.pool.connection() as (client, con):
+            first = con
+        with self.pool.connection() as (client, con):
+            self.assertEqual(first, con)
+        self.assertEqual(1, self.pool.misses)
+        self.assertEqual(1, self.pool.hits)
+        self.assertEqual(1, self.pool._client.service.opened)
+
+    def test_expired_sessions_are_evicted(self):
+        """
+        Tests that sessions idle for longer than the timeout are closed
+        """
+        with self.pool.connection() as (client, con):
+            pass
+        self.pool._idle[0].last_used -= 120
+        with self.pool.connection() as (client, con):
+            self.assertEqual('token-2', con)
+        self.assertEqual(1, self.pool.evictions)
+        self.assertEqual(1, self.pool._client.service.closed)
+
+    def test_failed_sessions_are_discarded(self):
+        """
+        Tests that a session that saw an error is not given back to the pool
+        """
+        try:
+            with self.pool.connection() as (client, con):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual([], self.pool._idle)
+        self.assertEqual(1, self.pool._client.service.closed)
+
+
+    def test_rejected_sessions_are_renewed(self):
+        """
+        Tests that a call rejected for its token is made again once with a
+        new session token
+        """
+        calls = []
+
+        class SessionFault(Exception):
+            fault = 'SESSION_RETRIEVING_FAILED'
+
+        def rejoin(con, email):
+            calls.append(con)
+            if con == 'token-1':
+                raise SessionFault('Session expired')
+        self.pool._client.service.rejoinMemberByEmail = rejoin
+
+        with self.pool.connection() as (client, con):
+            client.service.rejoinMemberByEmail(con, 'member@mail.com')
+            client.service.rejoinMemberByEmail(con, 'member@mail.com')
+        self.assertEqual(['token-1', 'token-2', 'token-2'], calls)
+        self.assertEqual('token-2', self.pool._idle[0].token)
+
+
+class MemberSyncTest(TestCase):
+
+    def test_failures_do_not_abort_the_batch(self):
+        """
+        Tests that save_many keeps pushing members after one of them fails
+        and reports the failed ones
+        """
+        from contextlib import contextmanager
+        pushed = []
+
+        class Service(object):
+            def insertOrUpdateMemberByObj(self, con, member):
+                if member.email == 'bad@mail.com':
+                    raise ValueError(member.email)
+                pushed.append(member.email)
+
+        class Client(object):
+            service = Service()
+
+        class Remote(MemberRemote):
+            connections = 0
+
+            @contextmanager
+            def get_connection(self):
+                self.connections += 1
+                yield Client(), 'token'
+
+            def _synchro_member(self, client, member):
+                return member
+
+        remote = Remote()
+        members = [Member(email=email) for email in
+                   ('a@mail.com', 'bad@mail.com', 'b@mail.com')]
+        failures = remote.save_many(members, chunk_size=2)
+
+        self.assertEqual(['a@mail.com', 'b@mail.com'], pushed)
+        self.assertEqual([members[1]], [member for member, e in failures])
+        self.assertEqual(2, remote.connections)
+
+    def test_connection_failure_fails_the_chunk(self):
+        """
+        Tests that the members of a chunk that couldn't get a connection are
+        reported as failed and the next chunks are still pushed
+        """
+        from contextlib import contextmanager
+        from ccommander.resilience import CircuitOpenError
+        pushed = []
+
+        class Service(object):
+            def insertOrUpdateMemberByObj(self, con, member):
+                pushed.append(member.email)
+
+        class Client(object):
+            service = Service()
+
+        class Remote(MemberRemote):
+            connections = 0
+
+            @contextmanager
+            def get_connection(self):
+                self.connections += 1
+                if self.connections == 1:
+                    raise CircuitOpenError('member')
+                yield Client(), 'token'
+
+            def _synchro_member(self, client, member):
+                return member
+
+        members = [Member(email=email) for email in
+                   ('a@mail.com', 'b@mail.com', 'c@mail.com')]
+        failures = Remote().save_many(members, chunk_size=2)
+
+        self.assertEqual(['c@mail.com'], pushed)
+        self.assertEqual(members[:2], [member for member, e in failures])
+
+
+class MapperTest(TestCase):
+
+    fixtures = ["campaign_test.json"]
+    multi_db = True
+
+    def test_serialize(self):
+        """
+        Tests that remote names, default values, remote values and DELETE
+        are applied when mapping an instance
+        """
+        from ccommander.mappers import serialize
+
+        class RemoteObject(object):
+            """Has every attribute of an apiCampaign"""
+            def __init__(self):
+                for field in Campaign._meta.fields:
+                    setattr(self, getattr(field, 'remote_name', field.name),
+                            None)
+
+        campaign = Campaign(
+            name='Test campaign',
+            url_end_campaign='http://url',
+            message=Message.objects.get(pk=1),
+            segment=Segment.objects.get(pk=1)
+        )
+        remote = serialize(campaign, RemoteObject())
+
+        self.assertFalse('id' in vars(remote))
+        self.assertFalse('status' in vars(remote))
+        self.assertFalse('lifeStatus' in vars(remote))
+        self.assertEqual('Test campaign', remote.name)
+        self.assertEqual('http://url', remote.urlEndCampaign)
+        self.assertEqual(1703672, remote.messageId)
+        self.assertEqual(1345, remote.mailinglistId)
+        self.assertEqual('', remote.description)
+
+
+class OutboxTest(TestCase):
+
+    def setUp(self):
+        Segment._remote = spy(SegmentRemote())
+        when(Segment._remote.save).then_return(4321)
+
+    def test_deferred_save(self):
+        """
+        Tests that with the outbox enabled the remote is not called on save
+        but when the outbox is dispatched
+        """
+        from django.test.utils import override_settings
+        from ccommander import outbox
+
+        with override_settings(CCOMMANDER_OUTBOX=True):
+            segment = Segment(name="Test segment")
+            segment.save()
+            segment.name = "Renamed segment"
+            segment.save()
+        assert_that_method(Segment._remote.save).was_never_called()
+        self.assertEqual(2, PendingSync.objects.count())
+
+        self.assertEqual(1, outbox.dispatch())
+        assert_that_method(Segment._remote.save).was_called()
+        self.assertEqual(0, PendingSync.objects.count())
+        self.assertEqual(4321, Segment.objects.get(pk=segment.pk).remote_id)
+
+    def test_failing_write_is_parked(self):
+        """
+        Tests that a write failing too many times stops blocking the outbox
+        """
+        from django.test.utils import override_settings
+        from ccommander import outbox
+
+        with override_settings(CCOMMANDER_OUTBOX=True):
+            Segment(name="Failing segment").save()
+            Segment(name="Next segment").save()
+        Segment._remote = spy(SegmentRemote())
+        when(Segment._remote.save).then_raise(ValueError('rejected'))
+        with override_settings(CCOMMANDER_OUTBOX_MAX_ATTEMPTS=2,
+                               CCOMMANDER_OUTBOX_RETRY_DELAY=0):
+            self.assertEqual(0, outbox.dispatch())
+            self.assertEqual(0, outbox.parked().count())
+            self.assertEqual(0, outbox.dispatch())
+            self.assertEqual(1, outbox.parked().count())
+            self.assertEqual(u'rejected', outbox.parked()[0].last_error)
+
+    def test_unreachable_remote_backs_off(self):
+        """
+        Tests that writes failing while the remote is down wait before
+        being tried again and are never parked
+        """
+        from django.test.utils import override_settings
+        from ccommander import outbox
+        from ccommander.resilience import CircuitOpenError
+
+        with override_settings(CCOMMANDER_OUTBOX=True):
+            Segment(name="Test segment").save()
+        Segment._remote = spy(SegmentRemote())
+        when(Segment._remote.save).then_raise(CircuitOpenError('ccmd'))
+        with override_settings(CCOMMANDER_OUTBOX_MAX_ATTEMPTS=1):
+            self.assertEqual(0, outbox.dispatch())
+            self.assertEqual(0, outbox.dispatch())
+        pending = PendingSync.objects.get()
+        self.assertEqual((0, 1), (pending.attempts, pending.retries))
+        self.assertTrue(pending.retry_at > pending.created_at)
+        self.assertEqual(4, outbox.retry_delay(3))
+
+
+class RemoteTrackingTest(TestCase):
+
+    def setUp(self):
+        Member._remote = spy(MemberRemote())
+
+    def test_unchanged_member_is_not_pushed(self):
+        """
+        Tests that saving a member without changes doesn't call the remote
+        and that only the changed fields are pushed
+        """
+        member = Member(email='member@mail.com')
+        member.save()
+        assert_that_method(Member._remote.save).was_called().with_args(member,
+                                                                       None)
+
+        skipped = RemoteTracking.skipped_remote_calls
+        member = Member.objects.get(pk=member.pk)
+        member.save()
+        self.assertEqual(skipped + 1, RemoteTracking.skipped_remote_calls)
+
+        member.firstname = 'Name'
+        member.save()
+        assert_that_method(Member._remote.save).was_called().with_args(
+                                                        member, ['firstname'])
+
+
+class CircuitBreakerTest(TestCase):
+
+    def test_opens_after_failures(self):
+        """
+        Tests that the breaker fails fast after too many transient errors and
+        lets a call through once the reset timeout passed
+        """
+        import socket
+        from ccommander.resilience import CircuitBreaker, CircuitOpenError
+
+        def fail():
+            raise socket.error()
+
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=60)
+        for i in range(2):
+            self.assertRaises(socket.error, breaker.call, fail)
+        self.assertRaises(CircuitOpenError, breaker.call, lambda: 1)
+
+        breaker.opened_at -= 120
+        self.assertEqual(1, breaker.call(lambda: 1))
+        self.assertFalse(breaker.is_open())
+
+    def test_retry(self):
+        """
+        Tests that transient errors are retried
+        """
+        import socket
+        from ccommander.resilience import retry
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise socket.error()
+            return 'ok'
+
+        self.assertEqual('ok', retry(flaky, attempts=3, base_delay=0))
+        self.assertEqual(3, len(calls))
+
+    def test_non_idempotent_calls_are_not_replayed(self):
+        """
+        Tests that operations that aren't idempotent are only retried when
+        the connection failed
+        """
+        import errno
+        import socket
+        from ccommander.resilience import is_idempotent, retry
+        calls = []
+
+        def timeout():
+            calls.append(1)
+            raise socket.timeout()
+
+        def refused():
+            calls.append(1)
+            if len(calls) < 2:
+                raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+            return 'ok'
+
+        self.assertFalse(is_idempotent('createCampaignByObj'))
+        self.assertTrue(is_idempotent('getCampaign'))
+        self.assertRaises(socket.timeout, retry, timeout, attempts=3,
+                          base_delay=0, idempotent=False)
+        self.assertEqual(1, len(calls))
+        del calls[:]
+        self.assertEqual('ok', retry(refused, attempts=3, base_delay=0,
+                                     idempotent=False))
+        self.assertEqual(2, len(calls))
+
+
+class MetricsTest(TestCase):
+
+    def tearDown(self):
+        from ccommander import metrics
+        metrics.configure([])
+
+    def test_prometheus_exporter(self):
+        """
+        Tests that timers and counters are aggregated and rendered
+        """
+        from ccommander import metrics
+
+        metrics.configure(['prometheus'])
+        with metrics.timer('remote.call.postCampaign'):
+            pass
+        metrics.incr('pool.hit')
+        metrics.incr('pool.hit')
+
+        text = metrics.get_exporter(metrics.PrometheusExporter).render()
+        self.assertTrue('ccommander_pool_hit_total 2' in text)
+        self.assertTrue('ccommander_remote_call_postCampaign_seconds_count 1'
+                        in text)
+
+    def test_serve(self):
+        """
+        Tests that the measures of the process are served over HTTP, with
+        the prometheus exporter enabled if needed
+        """
+        import urllib2
+        from ccommander import metrics
+
+        metrics.configure([])
+        server = metrics.serve(0, '127.0.0.1')
+        try:
+            metrics.incr('rpc.failed')
+            text = urllib2.urlopen('http://127.0.0.1:%d/metrics' %
+                                   server.server_address[1]).read()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertTrue('ccommander_rpc_failed_total 1' in text)
+
+    def test_disabled(self):
+        """
+        Tests that without exporters the no-op functions are used
+        """
+        from ccommander import metrics
+
+        metrics.configure([])
+        self.assertTrue(metrics.timer('x') is metrics.timer('y'))
+
+
+class CampaignBuilderTest(TestCase):
+
+    def setUp(self):
+        from django.conf import settings
+        from ccommander.pool import get_pool
+
+        pool = get_pool(settings.CCOMMANDER_API_CAMPAIGN_MANAGEMENT_WSDL)
+        pool._client = FakeClient()
+        self.service = pool._client.service
+        for model, remote, remote_id in ((Message, MessageRemote, 11),
+                                         (Segment, SegmentRemote, 22),
+                                         (Campaign, CampaignRemote, 33)):
+            model._remote = spy(remote())
+            when(model._remote.save).then_return(remote_id)
+        MirrorLink._remote = spy(MirrorLinkRemote())
+        Criteria._remote = spy(CriteriaRemote())
+
+    def test_build(self):
+        """
+        Tests that the whole graph is pushed over one session and saved
+        """
+        from ccommander.builder import CampaignBuilder
+
+        builder = CampaignBuilder(
+            message=Message(name="Message", subject="Subject", body="Body",
+                            to="[EMV FIELD]EMAIL[EMV /FIELD]"),
+            links=[MirrorLink(name="Mirror")],
+            segment=Segment(name="Segment"),
+            criteria=[Criteria(column_name="EMAIL", operator="EQUALS",
+                               values=["email1@mail.com"])],
+            campaign=Campaign(name="Campaign", url_end_campaign="http://url"))
+        campaign = builder.build(post=True)
+
+        assert_that_method(MirrorLink._remote.save).was_called()
+        assert_that_method(Criteria._remote.save).was_called()
+        assert_that_method(Campaign._remote.post).was_called().with_args(
+                                                                    campaign)
+        self.assertEqual(1, self.service.opened)
+        campaign = Campaign.objects.get(pk=campaign.pk)
+        self.assertEqual(33, campaign.remote_id)
+        self.assertEqual(11, campaign.message.remote_id)
+        self.assertEqual(22, campaign.segment.remote_id)
+        self.assertEqual(1, campaign.message.link_set.count())
+        self.assertEqual(1, campaign.segment.criteria_set.count())
+
+
+class MemberMembershipTest(TestCase):
+
+    def test_bulk_unjoin(self):
+        """
+        Tests that unjoining a queryset only deactivates the members
+        successfully unjoined remotely
+        """
+        Member._remote = spy(MemberRemote())
+        for email in ('a@mail.com', 'b@mail.com'):
+            Member.objects.create(email=email, is_active=True)
+        when(Member._remote.unjoin_many).then_return(
+            [('b@mail.com', ValueError())])
+
+        emails, failures = Member.objects.all().unjoin()
+
+        self.assertEqual(['a@mail.com'], emails)
+        self.assertEqual(['b@mail.com'], [email for email, e in failures])
+        self.assertFalse(Member.objects.get(email='a@mail.com').is_active)
+        self.assertTrue(Member.objects.get(email='b@mail.com').is_active)
+
+    def test_connection_failure_fails_the_chunk(self):
+        """
+        Tests that the emails of a chunk that couldn't get a connection are
+        reported as failed instead of aborting the others
+        """
+        from contextlib import contextmanager
+        from ccommander.resilience import CircuitOpenError
+
+        class Remote(MemberRemote):
+            chunk_size = 1
+
+            @contextmanager
+            def get_connection(self):
+                raise CircuitOpenError('member')
+                yield
+
+        failures = Remote().unjoin_many(['a@mail.com', 'b@mail.com'])
+        self.assertEqual(['a@mail.com', 'b@mail.com'],
+                         sorted(email for email, e in failures))
+
+    def test_chunk_size_setting(self):
+        """
+        Tests that the chunk size is read from the settings when used
+        """
+        from django.test.utils import override_settings
+        with override_settings(CCOMMANDER_MEMBER_CHUNK_SIZE=10):
+            self.assertEqual(10, MemberRemote().chunk_size)
+
+
+class StreamingTest(TestCase):
+
+    def test_short_csv_rows(self):
+        """
+        Tests that missing columns of short CSV rows are read as None
+        """
+        from StringIO import StringIO
+        from ccommander.streaming import read_rows
+        rows = list(read_rows(StringIO('email,firstname\nmember@mail.com\n'),
+                              'csv'))
+        self.assertEqual([{'email': u'member@mail.com', 'firstname': None}],
+                         rows)
+
+    def test_checkpoint_extra_values(self):
+        """
+        Tests that checkpoints keep the extra values saved with the position
+        """
+        import os
+        import tempfile
+        from ccommander.streaming import Checkpoint
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            checkpoint = Checkpoint(path)
+            checkpoint.save(42, offset=1024)
+            self.assertEqual(42, checkpoint.load())
+            self.assertEqual({'position': 42, 'offset': 1024},
+                             checkpoint.load_state())
+        finally:
+            os.remove(path)
+
+
+class SegmentCriteriaPushTest(TestCase):
+
+    def test_groups_are_created_first(self):
+        """
+        Tests that the first criteria of a group is pushed before the rest
+        of the group and that failures are reported
+        """
+        pushed = []
+
+        class Remote(object):
+            def save(self, criteria):
+                if criteria.column_name == 'FAIL':
+                    raise ValueError()
+                pushed.append(criteria.pk)
+
+        def criteria(pk, group_number, order_frag, column_name='EMAIL'):
+            c = Criteria(pk=pk, group_number=group_number,
+                         order_frag=order_frag, column_name=column_name)
+            c._remote = Remote()
+            return c
+
+        failures = SegmentRemote().save_criteria([
+            criteria(1, 1, 2), criteria(2, 1, 1), criteria(3, 1, 3),
+            criteria(4, 2, 4, 'FAIL'), criteria(5, 2, 5),
+            criteria(6, None, None), criteria(7, None, 7),
+            criteria(8, None, 6),
+        ], concurrency=2)
+
+        self.assertEqual(2, pushed[0])
+        self.assertEqual([1, 2, 3, 6, 7, 8], sorted(pushed))
+        # ungrouped criteria go in order, after the groups before them
+        self.assertEqual([8, 7, 6], pushed[3:])
+        self.assertEqual([4, 5], [c.pk for c, e in failures])
+
+    def test_save_without_push(self):
+        """
+        Tests that criteria saved with push=False are indexed but not pushed
+        """
+        Criteria._remote = spy(CriteriaRemote())
+        segment = Segment(name="Segment")
+        segment.save(push=False)
+        criteria = Criteria(column_name="EMAIL", operator="EQUALS",
+                            segment=segment, values=["email1@mail.com"])
+        criteria.save(push=False)
+        assert_that_method(Criteria._remote.save).was_never_called()
+        self.assertEqual([criteria], list(Criteria.objects.filter(
+            indexed_values__value='email1@mail.com')))
+
+
+class StringListFieldTest(TestCase):
+
+    fixtures = ["segment_test.json"]
+    multi_db = True
+
+    def setUp(self):
+        Criteria._remote = spy(CriteriaRemote())
+        self.criteria = Criteria.objects.create(
+            column_name='EMAIL', operator='EQUALS',
+            values=['email1@mail.com', 'email2@mail.com'],
+            segment=Segment.objects.get(pk=1))
+
+    def test_lazy_decoding(self):
+        """
+        Tests that values are only split when accessed
+        """
+        criteria = Criteria.objects.get(pk=self.criteria.pk)
+        self.assertFalse(criteria.values.decoded)
+        self.assertEqual(['email1@mail.com', 'email2@mail.com'],
+                         criteria.values)
+        self.assertTrue(criteria.values.decoded)
+        self.assertEqual(['x', 'email1@mail.com', 'email2@mail.com'],
+                         ['x'] + criteria.values)
+
+    def test_in_place_change_is_pushed(self):
+        """
+        Tests that values changed in place are seen as a remote change
+        """
+        criteria = Criteria.objects.get(pk=self.criteria.pk)
+        criteria.values.append('email3@mail.com')
+        self.assertEqual(['values'], criteria.remote_changes())
+
+        skipped = RemoteTracking.skipped_remote_calls
+        criteria.save()
+        self.assertEqual(skipped, RemoteTracking.skipped_remote_calls)
+
+    def test_storage_round_trip(self):
+        """
+        Tests that lists with empty strings are read back as they were saved
+        """
+        field = Criteria._meta.get_field('values')
+        for values in ([], [''], ['', 'a'], ['a', '']):
+            self.assertEqual(values,
+                             field.to_python(field.get_prep_value(values)))
+
+    def test_contains_lookup(self):
+        """
+        Tests that single values can be looked up, in the column and in the
+        indexed side table
+        """
+        self.assertEqual([self.criteria], list(Criteria.objects.filter(
+            values__contains='email2@mail.com')))
+        self.assertEqual([], list(Criteria.objects.filter(
+            values__contains='email2')))
+        self.assertEqual([self.criteria], list(Criteria.objects.filter(
+            indexed_values__value='email1@mail.com')))
+
+
+class AsyncRemoteTest(TestCase):
+
+    def test_calls_run_in_the_background(self):
+        """
+        Tests that async remotes return results of the blocking remote calls
+        """
+        from ccommander.asyncremotes import AsyncMemberRemote, gather
+        remote = AsyncMemberRemote(spy(MemberRemote()))
+        when(remote.remote.save).then_return('saved')
+        when(remote.remote.rejoin).then_raise(ValueError())
+        members = [Member(email='a@mail.com'), Member(email='b@mail.com')]
+
+        results = [remote.save(member) for member in members]
+        self.assertEqual(['saved', 'saved'], gather(results))
+        assert_that_method(remote.remote.save).was_called()\
+                                              .with_args(members[1])
+        failed = gather([remote.rejoin(members[0])], return_exceptions=True)
+        self.assertIsInstance(failed[0], ValueError)
+
+
+class ReconcileTest(TestCase):
+
+    fixtures = ["campaign_test.json"]
+    multi_db = True
+
+    def setUp(self):
+        class RemoteCampaign(object):
+            def __init__(self, id, name, segment_id):
+                self.id = id
+                self.name = name
+                self.urlEndCampaign = 'http://url'
+                self.messageId = 1703672
+                self.mailinglistId = segment_id
+
+        self.remote_objects = [RemoteCampaign(10, 'New', 1345),
+                               RemoteCampaign(11, 'Orphan', 999)]
+        Campaign._remote = spy(CampaignRemote())
+        when(Campaign._remote.modified_since).then_return(self.remote_objects)
+
+    def test_dry_run(self):
+        """
+        Tests that a dry run reports the changes without applying them
+        """
+        from ccommander.reconcile import reconcile_model
+
+        report = reconcile_model(Campaign, dry_run=True)
+        self.assertEqual([10], report.created)
+        self.assertEqual([11], report.skipped.keys())
+        self.assertEqual(0, Campaign.objects.count())
+        self.assertIsNone(SyncWatermark.objects.get().synced_until)
+
+    def test_incremental_pull(self):
+        """
+        Tests that remote objects are inserted, then updated, that skipped
+        objects keep the watermark and that the next pull starts at it
+        """
+        from ccommander.reconcile import reconcile_model
+
+        first = reconcile_model(Campaign)
+        campaign = Campaign.objects.get(remote_id=10)
+        self.assertEqual(1, campaign.segment.pk)
+        self.assertEqual(1, campaign.message.pk)
+
+        self.remote_objects[0].name = 'Renamed'
+        second = reconcile_model(Campaign)
+        self.assertEqual(first.since, second.since)
+        self.assertEqual({10: ['name']}, second.changes)
+        self.assertEqual('Renamed', Campaign.objects.get(remote_id=10).name)
+
+        # the orphan can't be applied, it's gone from the remote now
+        self.remote_objects.pop()
+        third = reconcile_model(Campaign)
+        self.assertEqual(third.until, reconcile_model(Campaign).since)
+        assert_that_method(Campaign._remote.save).was_never_called()
+
+
+class LRUCacheTest(TestCase):
+
+    def test_least_recently_used_is_evicted(self):
+        """
+        Tests that the cache keeps the most recently used items
+        """
+        from ccommander.cache import LRUCache
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(2, len(cache))
+
+
+class FakeTransport(object):
+
+    errors = ()
+
+    def get_client(self, url):
+        return FakeClient()
+
+
+class TransportTest(TestCase):
+
+    def test_registered_transport(self):
+        """
+        Tests that pools build their clients with the configured transport
+        """
+        from django.test.utils import override_settings
+        from ccommander import transports
+        from ccommander.pool import SessionPool
+
+        transports.register('fake', 'ccommander.tests.FakeTransport')
+        with override_settings(CCOMMANDER_TRANSPORT='fake'):
+            pool = SessionPool('http://wsdl')
+            with pool.connection() as (client, con):
+                self.assertEqual('token-1', con)
+        self.assertEqual(MemberRemote.wsdl_setting,
+                         'CCOMMANDER_API_MEMBER_UPDATE_WSDL')
+
+
+class EnvelopeParityTest(TestCase):
+    """The fast serializer must write the envelopes suds writes"""
+
+    def soap_client(self, service):
+        import os
+        import suds.client
+
+        path = os.path.join(os.path.dirname(__file__), 'fixtures', 'wsdl',
+                            '%s.wsdl' % service)
+        return suds.client.Client('file://' + path, cache=None, nosend=True)
+
+    def assertParity(self, client, operation, *args):
+        from ccommander.envelopes import get_serializer
+        expected = getattr(client.service, operation)(*args).envelope
+        self.assertEqual(expected,
+                         get_serializer(client).render(operation, *args))
+
+    def test_member(self):
+        client = self.soap_client('member')
+        member = client.factory.create('synchroMember')
+        member.email = u'm\xe9mber@mail.com'
+        member.dynContent.entry.extend([
+            {'key': 'FIRSTNAME', 'value': u'<Jos\xe9 & co>'},
+            {'key': 'IS_ACTIVE', 'value': 1},
+            {'key': 'CREATED', 'value': datetime.datetime(2012, 2, 24, 18)},
+            {'key': 'PHONE', 'value': ''},
+            {'key': '', 'value': ''}])
+        self.assertParity(client, 'insertOrUpdateMemberByObj', 'tk', member)
+        self.assertParity(client, 'insertOrUpdateMemberByObj', 'tk',
+                          client.factory.create('synchroMember'))
+
+    def test_campaign_management(self):
+        client = self.soap_client('ccmd')
+        message = client.factory.create('apiMessage')
+        message.name = 'Message'
+        message.body = u'[EMV TEXTPART] <b>Body</b>'
+        message.isBounceback = False
+        del message.id
+        self.assertParity(client, 'createEmailMessageByObj', 'tk', message)
+
+        segment = client.factory.create('apiSegmentation')
+        segment.name = 'Segment'
+        segment.sampleType = 'ALL'
+        self.assertParity(client, 'segmentationCreateSegment', 'tk', segment)
+
+        campaign = client.factory.create('apiCampaign')
+        campaign.name = 'Campaign'
+        campaign.sendDate = datetime.datetime(2012, 2, 24, 18, 5)
+        campaign.deliverySpeed = 0
+        campaign.messageId = 11
+        self.assertParity(client, 'createCampaignByObj', 'tk', campaign)
+
+    def test_notification(self):
+        client = self.soap_client('nms')
+        request = client.factory.create('sendRequest')
+        request.email = 'member@mail.com'
+        request.notificationId = 'ABC'
+        request.content.entry.append({'key': 1, 'value': 'Content'})
+        del request.dyn
+        self.assertParity(client, 'sendObject', request)
+
+    def test_records(self):
+        """
+        Tests that Records render like the suds objects they stand for
+        """
+        from ccommander.envelopes import get_serializer
+        client = self.soap_client('member')
+        serializer = get_serializer(client)
+        member = client.factory.create('synchroMember')
+        record = serializer.create('synchroMember')
+        for m in (member, record):
+            m.email = 'member@mail.com'
+            m.dynContent.entry.append({'key': 'FIRSTNAME', 'value': 'Jose'})
+        self.assertParity(client, 'insertOrUpdateMemberByObj', 'tk', member)
+        self.assertEqual(
+            serializer.render('insertOrUpdateMemberByObj', 'tk', member),
+            serializer.render('insertOrUpdateMemberByObj', 'tk', record))
+
+
+class SchedulerTest(TestCase):
+
+    def test_weighted_fair_scheduling(self):
+        """
+        Tests that lanes get turns by weight and never run more requests
+        than their concurrency
+        """
+        from collections import OrderedDict
+        from ccommander.rpc import Lane, Scheduler
+
+        lanes = OrderedDict([
+            ('transactional', Lane('transactional', 'q1', weight=3,
+                                   concurrency=10)),
+            ('bulk', Lane('bulk', 'q2', weight=1, concurrency=1))])
+        scheduler = Scheduler(lanes)
+        for i in range(10):
+            scheduler.add('bulk', 'sync %d' % i)
+            scheduler.add('transactional', 'email %d' % i)
+
+        picked = [scheduler.next() for i in range(4)]
+        self.assertEqual(['transactional', 'transactional', 'bulk',
+                          'transactional'], [lane for lane, r in picked])
+        # bulk is at its concurrency limit until its request is done
+        self.assertEqual('transactional', scheduler.next()[0])
+        self.assertEqual('transactional', scheduler.next()[0])
+        scheduler.done('bulk')
+        self.assertIn(('bulk', 'sync 1'), [scheduler.next() for i in range(4)])
+
+
+class RateLimiterTest(TestCase):
+
+    def test_token_bucket(self):
+        """
+        Tests that calls beyond the burst wait for the bucket to refill, with
+        the bucket shared through SQLite
+        """
+        import os
+        import shutil
+        import tempfile
+        import time
+        from ccommander.ratelimit import RateLimiter, SQLiteStore
+
+        directory = tempfile.mkdtemp()
+        try:
+            store = SQLiteStore(os.path.join(directory, 'ratelimit.sqlite'))
+            now = time.time()
+            self.assertEqual(0, store.take('member', 10, 2, now))
+            self.assertEqual(0, store.take('member', 10, 2, now))
+            self.assertAlmostEqual(0.1, store.take('member', 10, 2, now))
+            self.assertEqual(0, store.take('member', 10, 2, now + 0.1))
+
+            # another process sharing the file sees the same bucket
+            other = SQLiteStore(store.path)
+            self.assertAlmostEqual(0.1, other.take('member', 10, 2,
+                                                   now + 0.1))
+
+            limiter = RateLimiter('notification', 100, 1, store)
+            started = time.time()
+            for i in range(3):
+                limiter.acquire()
+            self.assertTrue(time.time() - started >= 0.015)
+        finally:
+            shutil.rmtree(directory)
+
+
+class CampaignStatusService(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def getCampaignStatus(self, con, id):
+        self.calls += 1
+        return 'EDITABLE' if self.calls == 1 else 'RUNNING'
+
+    def postCampaign(self, con, id):
+        return True
+
+
+class ReadCacheTest(TestCase):
+
+    def test_items_expire(self):
+        """
+        Tests that the in-process cache drops items after their ttl
+        """
+        import time
+        from ccommander.cache import LRUCache
+        cache = LRUCache(max_size=2, ttl=0.01)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=60)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertFalse('a' in cache)
+        self.assertEqual(2, cache.get('b'))
+
+    def test_read_through_and_invalidation(self):
+        """
+        Tests that remote reads are cached until the object is written
+        through the remote
+        """
+        from ccommander.cache import get_read_cache
+        from ccommander.remotes import CampaignRemote, bind_connection
+
+        get_read_cache().clear()
+        remote = CampaignRemote()
+        client = FakeClient()
+        client.service = CampaignStatusService()
+        campaign = Campaign(remote_id=42)
+        with bind_connection(remote.wsdl, client, 'token'):
+            self.assertEqual('EDITABLE', remote.status(42))
+            self.assertEqual('EDITABLE', remote.status(42))
+            self.assertEqual(1, client.service.calls)
+
+            remote.post(campaign)
+            self.assertEqual('RUNNING', remote.status(42))
+            self.assertEqual(2, client.service.calls)
@@ -0,0 +1,61 @@
+"""Registry of the SOAP backends used to talk to Campaign Commander
+
+Importing ccommander (its models included) doesn't load any SOAP library,
+the transport named by CCOMMANDER_TRANSPORT ('suds' by default) is imported
+the first time a client is needed. Other transports can be registered by
+dotted path in CCOMMANDER_TRANSPORTS:
+
+    CCOMMANDER_TRANSPORTS = {'fake': 'myproject.tests.FakeTransport'}
+    CCOMMANDER_TRANSPORT = 'fake'
+
+A transport has a ``get_client(url)`` method returning a suds-like client
+(with ``service``, ``factory`` and ``clone()``) and an ``errors`` tuple with
+its transient exceptions (see ccommander.resilience).
+"""
+import threading
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+
+class SudsTransport(object):
+    """suds clients, built from the WSDL cache when it's enabled"""
+
+    @property
+    def errors(self):
+        import suds.transport
+        return (suds.transport.TransportError,)
+
+    def get_client(self, url):
+        from ccommander import wsdl
+        return wsdl.get_client(url)
+
+
+_registry = {'suds': 'ccommander.transports.SudsTransport'}
+_transports = {}
+_lock = threading.Lock()
+
+
+def register(name, path):
+    """Registers the transport class at the dotted path under name"""
+    with _lock:
+        _registry[name] = path
+        _transports.pop(name, None)
+
+
+def get_transport(name=None):
+    """Returns the transport with the given name (the configured one by
+    default), importing it on first use
+    """
+    name = name or getattr(settings, 'CCOMMANDER_TRANSPORT', 'suds')
+    transport = _transports.get(name)
+    if transport is None:
+        with _lock:
+            transport = _transports.get(name)
+            if transport is None:
+                registry = dict(_registry, **getattr(
+                    settings, 'CCOMMANDER_TRANSPORTS', {}))
+                module, attr = registry[name].rsplit('.', 1)
+                transport = getattr(import_module(module), attr)()
+                _transports[name] = transport
+    return transport
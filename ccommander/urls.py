@@ -0,0 +1,6 @@
+from django.conf.urls import patterns, url
+
+# only the measures of the web process, see ccommander.metrics
+urlpatterns = patterns('ccommander.views',
+    url(r'^metrics$', 'metrics', name='ccommander-metrics'),
+)
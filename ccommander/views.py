@@ -1 +1,15 @@
 # Create your views here.
+from django import http
+
+
+def metrics(request):
+    """Exposes the measures of the prometheus exporter (see
+    ccommander.metrics) in the Prometheus text format
+    """
+    from ccommander.metrics import PrometheusExporter, get_exporter
+
+    exporter = get_exporter(PrometheusExporter)
+    if exporter is None:
+        raise http.Http404()
+    return http.HttpResponse(exporter.render(),
+                             content_type='text/plain; version=0.0.4')
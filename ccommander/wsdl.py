@@ -0,0 +1,162 @@
+"""On-disk cache of the parsed WSDL and schema documents
+
+Set CCOMMANDER_WSDL_CACHE_DIR in django settings to keep the parsed
+definitions of every WSDL (and the schemas it imports) on disk, so that
+building a client doesn't touch the network:
+
+    CCOMMANDER_WSDL_CACHE_DIR = '/var/cache/ccommander/wsdl'
+    CCOMMANDER_WSDL_CACHE_TTL = 24 * 60 * 60
+
+Each WSDL gets its own suds ObjectCache and a manifest with the sha1 of the
+WSDL document. Once the manifest is older than CCOMMANDER_WSDL_CACHE_TTL
+seconds the document is downloaded again: if its hash didn't change the
+cache is kept, otherwise it's rebuilt. When the WSDL host can't be reached
+the cached definitions are used anyway, so workers can start offline.
+
+The cache is prewarmed by the wsdl-cache management command. Caches are
+built in a temporary directory and renamed into place, so workers starting
+together on a cold cache don't trip over each other.
+"""
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import urllib2
+
+from django.conf import settings
+from django.utils.log import getLogger, NullHandler
+
+logger = getLogger('ccommander.wsdl')
+if not logger.handlers:
+    logger.addHandler(NullHandler())
+
+
+class WSDLCache(object):
+    """Cache of parsed WSDLs stored in location"""
+
+    def __init__(self, location, ttl=24 * 60 * 60, timeout=30):
+        self.location = location
+        self.ttl = ttl
+        self.timeout = timeout
+
+    def _path(self, url, *parts):
+        return os.path.join(self.location, hashlib.sha1(url).hexdigest(),
+                            *parts)
+
+    def _read_manifest(self, url):
+        try:
+            with open(self._path(url, 'manifest.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write_manifest(self, url, digest, directory=None):
+        directory = directory or self._path(url)
+        # written aside and renamed, readers never see a partial manifest
+        fd, path = tempfile.mkstemp(dir=directory, prefix='.manifest-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'url': url, 'sha1': digest,
+                       'fetched_at': time.time()}, f)
+        os.rename(path, os.path.join(directory, 'manifest.json'))
+
+    def _fetch_digest(self, url):
+        document = urllib2.urlopen(url, timeout=self.timeout).read()
+        return hashlib.sha1(document).hexdigest()
+
+    def _client(self, url, directory=None):
+        import suds.client
+        from suds.cache import ObjectCache
+        directory = directory or self._path(url)
+        return suds.client.Client(
+            url, cache=ObjectCache(location=os.path.join(directory, 'suds')))
+
+    def prewarm(self, url):
+        """Downloads, parses and stores the WSDL, replacing any cached copy
+
+        When another process replaced it at the same time its copy is kept.
+        """
+        digest = self._fetch_digest(url)
+        try:
+            os.makedirs(self.location)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        building = tempfile.mkdtemp(dir=self.location, prefix='.build-')
+        os.chmod(building, 0755)
+        try:
+            self._client(url, building)
+            self._write_manifest(url, digest, building)
+            self._replace(self._path(url), building)
+        finally:
+            shutil.rmtree(building, ignore_errors=True)
+        return self._client(url)
+
+    def _replace(self, path, building):
+        """Renames the directory building to path"""
+        if os.path.exists(path):
+            old = tempfile.mkdtemp(dir=self.location, prefix='.old-')
+            try:
+                os.rename(path, os.path.join(old, 'cache'))
+            except OSError, e:
+                # another process moved it already
+                if e.errno != errno.ENOENT:
+                    raise
+            shutil.rmtree(old, ignore_errors=True)
+        try:
+            os.rename(building, path)
+        except OSError, e:
+            # another process renamed its own copy into place first
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+
+    def revalidate(self, url, manifest):
+        """Rebuilds the cache of url if its WSDL document changed"""
+        try:
+            digest = self._fetch_digest(url)
+        except (IOError, urllib2.URLError), e:
+            logger.warning('Using the cached %s, it could not be revalidated: '
+                           '%s', url, e)
+            return
+        if digest == manifest['sha1']:
+            self._write_manifest(url, digest)
+        else:
+            self.prewarm(url)
+
+    def get_client(self, url):
+        """Returns a suds client of url built from the cache"""
+        manifest = self._read_manifest(url)
+        if manifest is None:
+            return self.prewarm(url)
+        if time.time() - manifest['fetched_at'] > self.ttl:
+            self.revalidate(url, manifest)
+        return self._client(url)
+
+    def clear(self, url):
+        shutil.rmtree(self._path(url), ignore_errors=True)
+
+
+def get_cache():
+    """Returns the cache configured in django settings, None if disabled"""
+    location = getattr(settings, 'CCOMMANDER_WSDL_CACHE_DIR', None)
+    if location:
+        return WSDLCache(location,
+                         getattr(settings, 'CCOMMANDER_WSDL_CACHE_TTL',
+                                 24 * 60 * 60))
+
+
+def get_client(url):
+    """Returns a suds client of url, built from the cache when enabled"""
+    cache = get_cache()
+    if cache is None:
+        import suds.client
+        return suds.client.Client(url)
+    return cache.get_client(url)
+
+
+def configured_wsdls():
+    """Returns the values of the CCOMMANDER_API_*_WSDL settings"""
+    return [getattr(settings, name) for name in sorted(dir(settings))
+            if name.startswith('CCOMMANDER_API_') and name.endswith('_WSDL')]